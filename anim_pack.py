@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# упакованный формат анимации: один файл с заголовком, таблицей смещений кадров
+# и самими кадрами. Кадр хранится либо целиком (RGB/RGBA), либо как сжатая zlib
+# разница (xor) с предыдущим кадром. Файл читается через mmap, обращение к кадру
+# декодирует его в поверхность формата экрана; хранением кадров (все или скользящее
+# окно) и фоновой догрузкой занимается LazyFrames в main.py, которому PackedAnimation
+# передаётся как источник кадров.
+#
+# сборка из последовательности png:
+#     python anim_pack.py data/boss_background_anim bgrnd_space_boss data/bgrnd_space_boss.anim
+import os
+import sys
+import mmap
+import zlib
+import struct
+import threading
+import numpy
+import pygame
+
+MAGIC = b"STAN"
+VERSION = 1
+RAW = 0
+DELTA = 1
+# магия, версия, число каналов, ширина, высота, число кадров
+HEADER = struct.Struct("<4sHHIII")
+# смещение, длина и способ хранения кадра
+ENTRY = struct.Struct("<QIB")
+
+
+def pack(names, path, key_every=30, mode="RGB"):
+    size = None
+    prev = None
+    payloads = []
+    for i, name in enumerate(names):
+        image = pygame.image.load(name)
+        if size is None:
+            size = image.get_size()
+        elif image.get_size() != size:
+            raise ValueError(f"{name}: все кадры анимации должны быть одного размера")
+        frame = pygame.image.tostring(image, mode)
+        if i % key_every == 0:
+            payloads.append((RAW, frame))
+        else:
+            delta = numpy.frombuffer(frame, numpy.uint8) ^ numpy.frombuffer(prev, numpy.uint8)
+            payloads.append((DELTA, zlib.compress(delta.tobytes(), 6)))
+        prev = frame
+    offset = HEADER.size + ENTRY.size * len(payloads)
+    with open(path, mode="wb") as packed:
+        packed.write(HEADER.pack(MAGIC, VERSION, len(mode), size[0], size[1], len(payloads)))
+        for encoding, data in payloads:
+            packed.write(ENTRY.pack(offset, len(data), encoding))
+            offset += len(data)
+        for encoding, data in payloads:
+            packed.write(data)
+
+
+class PackedAnimation:
+    def __init__(self, path):
+        self.file = open(path, mode="rb")
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, channels, w, h, count = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: неизвестный формат анимации")
+        self.size = (w, h)
+        self.mode = "RGB" if channels == 3 else "RGBA"
+        self.index = [ENTRY.unpack_from(self.buf, HEADER.size + ENTRY.size * i) for i in range(count)]
+        self.cur_i = -1
+        self.cur = None
+        # кадры декодируются из потока игры и из фонового потока LazyFrames
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        with self.lock:
+            frame = self.decode(i)
+            return frame.convert() if self.mode == "RGB" else frame.convert_alpha()
+
+    def decode(self, i):
+        offset, length, encoding = self.index[i]
+        if encoding == RAW:
+            return pygame.image.frombuffer(memoryview(self.buf)[offset:offset + length], self.size, self.mode)
+        if self.cur_i != i:
+            # восстановление кадра от ближайшего целого кадра или от последнего декодированного
+            start = i
+            while self.index[start][2] != RAW:
+                start -= 1
+            if start < self.cur_i < i:
+                start = self.cur_i
+            else:
+                offset, length, encoding = self.index[start]
+                self.cur = numpy.frombuffer(self.buf, numpy.uint8, length, offset)
+            for j in range(start + 1, i + 1):
+                offset, length, encoding = self.index[j]
+                self.cur = self.cur ^ numpy.frombuffer(zlib.decompress(self.buf[offset:offset + length]),
+                                                       numpy.uint8)
+            self.cur_i = i
+        return pygame.image.frombuffer(self.cur, self.size, self.mode)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("использование: python anim_pack.py <папка> <префикс кадров> <файл.anim> [кадров между целыми]")
+        raise SystemExit(1)
+    folder, prefix, out = sys.argv[1:4]
+    count = len([name for name in os.listdir(folder) if name.startswith(prefix) and name.endswith(".png")])
+    pack([os.path.join(folder, f"{prefix}{i}.png") for i in range(count)], out,
+         int(sys.argv[4]) if len(sys.argv) > 4 else 30)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# замеры производительности игровых подсистем без окна и звука:
+#     python bench.py check_hit
+#     python bench.py entities 10000
+import os
+import sys
+import random
+import timeit
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import pygame
+import main
+
+
+def make_player():
+    main.player = main.Player(main.assets.image("player_ship_anim_sheet.png", -1), 4, 1,
+                              main.screen_size[0] // 2, main.screen_size[1] // 2, main.player_group, 6, 400, 1200,
+                              pygame.mask.from_surface(main.assets.image("player_ship.png", -1)))
+    main.health_bar = main.HealthBar(main.assets.image("health_bar_anim_sheet.png"), 3, 2, 20, 20, main.player_group)
+    return main.player
+
+
+# стоимость проверки попаданий по игроку за кадр при n живых снарядах
+def bench_check_hit(n=500, frames=200):
+    player = make_player()
+    player.inv = True
+    random.seed(0)
+    spots = [(random.randint(0, main.screen_size[0]), random.randint(0, main.screen_size[1])) for _ in range(n)]
+    shots = [main.stars.get(x, y, 0, 0) for x, y in spots]
+
+    def revive():
+        for i, shot in enumerate(shots):
+            if not shot.alive():
+                shots[i] = main.stars.get(*spots[i], 0, 0)
+
+    def every_shot():
+        for shot in shots:
+            player.check_hit(shot)
+        revive()
+
+    def broad_phase():
+        main.collisions.check()
+        revive()
+
+    for name, frame in (("check_hit для каждого снаряда", every_shot), ("Collisions.check", broad_phase)):
+        t = timeit.timeit(frame, number=frames) / frames
+        print(f"{name}: {t * 1000:.3f} мс/кадр при {n} снарядах")
+
+
+# шаг движения, проверка попаданий и отрисовка n пуль из BulletPool за кадр
+def bench_bullets(n=5000, frames=100):
+    player = make_player()
+    player.inv = True
+    random.seed(0)
+
+    def refill():
+        while len(main.bullets) < n:
+            main.bullets.spawn(random.randint(0, main.screen_size[0]), random.randint(0, main.screen_size[1]),
+                               random.randint(0, 400), random.randint(0, 359), main.star_piece_image)
+
+    def frame():
+        refill()
+        main.bullets.update()
+        main.collisions.check()
+        main.bullets.draw(main.screen)
+
+    refill()
+    t = timeit.timeit(frame, number=frames) / frames
+    print(f"BulletPool: {t * 1000:.3f} мс/кадр при {n} пулях (бюджет кадра {1000 / main.FPS:.1f} мс)")
+
+
+# шаг, подготовка к отрисовке и отрисовка n звёзд пула stars за кадр и память на одну звезду
+def bench_entities(n=1000, frames=60):
+    main.data_dict["lvl"] = "1"
+    random.seed(0)
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for _ in range(n):
+        main.stars.get(random.randint(0, main.screen_size[0]), random.randint(-300, 0),
+                       random.randint(200, 400), random.randint(180, 360))
+    size = (tracemalloc.get_traced_memory()[0] - start) / n
+    tracemalloc.stop()
+
+    def frame():
+        main.stars.save()
+        main.stars.update()
+        main.stars.draw(main.screen, alpha=0.5)
+
+    update = timeit.timeit(main.stars.update, number=frames) / frames
+    t = timeit.timeit(frame, number=frames) / frames
+    print(f"EntityPool: {n} звёзд, update {update * 1000:.2f} мс/кадр, кадр с отрисовкой {t * 1000:.2f} мс, "
+          f"{size:.0f} байт на звезду")
+    main.stars.kill()
+
+
+# выдача событий уровня из n событий: стоимость кадра не должна зависеть от n
+def bench_level(n=50000, frames=1000):
+    step = 1000 / main.FPS
+    level = main.LevelScript([(i * frames * step // n, "star", 0, 0, 0, 0) for i in range(n)])
+    clock = [0]
+
+    def frame():
+        clock[0] += step
+        level.due(clock[0])
+
+    t = timeit.timeit(frame, number=frames) / frames
+    print(f"LevelScript: {t * 1000000:.1f} мкс/кадр при {n} событиях")
+
+
+if __name__ == "__main__":
+    benches = {name[len("bench_"):]: f for name, f in globals().items() if name.startswith("bench_")}
+    if len(sys.argv) < 2 or sys.argv[1] not in benches:
+        print("использование: python bench.py", "|".join(benches))
+        raise SystemExit(1)
+    benches[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
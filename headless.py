@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# прогон уровней без окна и звука с максимальной скоростью: настоящий код объектов игры,
+# но без ожидания clock.tick и без вывода на экран; печатает скорость симуляции в кадрах/с
+#     python headless.py 1 2 3 4          - уровни из data/lvl_0N.csv
+#     python headless.py 5 --frames 3000  - уровень босса (случайные волны) ограниченной длины
+#     python headless.py 2 --god --draw   - неуязвимый игрок, кадры рисуются во внеэкранный буфер
+#     python headless.py 3 --profile prof.json - время фаз кадра сохраняется в json или csv
+#     python headless.py --replay runs/*.rec - воспроизведение записей управления с отчётом
+#                                              о времени кадра и числе объектов для каждой
+import os
+import timeit
+import argparse
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+import recording
+
+
+# каждый кадр выполняет ровно один шаг симуляции без ожидания; после limit кадров сцена завершается
+class HeadlessLoop(main.GameLoop):
+    def __init__(self, limit, god=False):
+        super().__init__(main.FPS)
+        self.limit = limit
+        self.god = god
+        self.frames = 0
+
+    def reset(self):
+        self.frames = 0
+        if self.god and main.player is not None:
+            main.player.god = True
+
+    def steps(self):
+        if self.frames >= self.limit:
+            main.running = False
+            return 0
+        self.frames += 1
+        return 1
+
+    def alpha(self):
+        return 1.0
+
+
+# кадры либо не рисуются совсем, либо рисуются, но не выводятся на экран
+class HeadlessRenderer(main.Renderer):
+    def __init__(self, draw=False):
+        super().__init__(main.screen, main.all_sprites)
+        self.enabled = draw
+
+    def draw(self, layers, offset=(0, 0), alpha=1.0):
+        if self.enabled:
+            super().draw(layers, offset, alpha)
+
+    def flip(self):
+        pass
+
+
+# при воспроизведении уровень и зерно берутся из записи, а уровень должен закончиться
+# ровно на последнем записанном шаге, иначе симуляция разошлась с записью;
+# прерванная запись (например, ограничением --frames) проигрывается ровно до своего конца
+def run_level(lvl, limit, god=False, draw=False, replay=None):
+    main.MUSIC = False
+    main.controls.replay = replay
+    if replay is not None:
+        lvl = replay.lvl
+        limit = len(replay) + (main.FPS if replay.finished else 0)
+    main.loop = HeadlessLoop(limit, god)
+    main.renderer = HeadlessRenderer(draw)
+    main.running = True
+    main.state = "game"
+    main.time = 0
+    main.data_dict["lvl"] = str(lvl)
+    main.fade.fade = 1
+    main.fade.image = main.black
+    main.fade.image.set_alpha(255)
+    # кадры заднего плана босса загружаются до замера, а кэш пульсации очищается,
+    # чтобы замер не зависел от чтения png и от уровней, сыгранных раньше в том же прогоне
+    main.pulse_cache.clear()
+    if lvl == main.levels:
+        for i in range(len(main.bgrnd_boss_frames)):
+            main.bgrnd_boss_frames[i]
+    # пиковые числа объектов считаются для каждого уровня отдельно
+    for pool in (main.stars, main.bullets, main.laser_blaster_pool):
+        pool.reset_stats()
+    t = timeit.timeit(main.game, number=1)
+    frames = main.loop.frames
+    result = {"lvl": lvl, "frames": frames, "seconds": t, "sim_fps": frames / t if t else 0.0,
+              "result": main.state if main.running else "limit",
+              "stars": main.stars.stats()["high_water"],
+              "bullets": main.bullets.stats()["high_water"],
+              "blasters": main.laser_blaster_pool.stats()["high_water"],
+              "pulse_mb": main.pulse_cache.stats()["bytes"] / 2 ** 20,
+              "desync": replay is not None and (frames != len(replay) or
+                                                (main.state != "game") != replay.finished)}
+    if main.player is not None:
+        main.player.kill()
+    main.health_bar.kill()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="прогон уровней без окна")
+    parser.add_argument("levels", nargs="*", type=int)
+    parser.add_argument("--frames", type=int, default=20000, help="ограничение длины уровня в кадрах")
+    parser.add_argument("--god", action="store_true", help="неуязвимый игрок")
+    parser.add_argument("--draw", action="store_true", help="рисовать кадры во внеэкранный буфер")
+    parser.add_argument("--profile", help="файл .csv или .json для статистики фаз кадра")
+    parser.add_argument("--seed", type=int, help="зерно случайных чисел уровней")
+    parser.add_argument("--record", help="папка для записей управления сыгранных уровней")
+    parser.add_argument("--replay", nargs="+", default=[], help="файлы записей управления .rec")
+    args = parser.parse_args()
+    main.SEED = args.seed
+    main.RECORD_DIR = args.record
+    main.profiler.enabled = args.profile is not None or bool(args.replay)
+    main.profiler.window = args.frames
+    runs = [(lvl, None) for lvl in args.levels] + [(None, recording.load(name)) for name in args.replay]
+    desync = False
+    for i, (lvl, replay) in enumerate(runs):
+        main.profiler.reset()
+        res = run_level(lvl, args.frames, args.god, args.draw, replay)
+        print(f"уровень {res['lvl']}: {res['result']}, {res['frames']} кадров за {res['seconds']:.2f} с "
+              f"({res['sim_fps']:.0f} кадров/с), пиковое число звёзд {res['stars']}, пуль {res['bullets']}, "
+              f"лазеров {res['blasters']}, кэш пульсации {res['pulse_mb']:.1f} МБ")
+        if main.profiler.enabled:
+            p50, p95, p99, top = main.profiler.percentiles()["frame"]
+            counts = ", ".join(f"{name} {max(values)}" for name, values in main.profiler.counts.items())
+            print(f"    кадр p50 {p50:.2f} p95 {p95:.2f} p99 {p99:.2f} макс. {top:.2f} мс; объектов: {counts}")
+        if res["desync"]:
+            print(f"    рассинхронизация: в записи {len(replay)} шагов")
+            desync = True
+        if args.profile is not None:
+            root, ext = os.path.splitext(args.profile)
+            main.profiler.dump(args.profile if len(runs) == 1 else f"{root}_{i + 1}{ext}")
+    if desync:
+        raise SystemExit(1)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# скомпилированный формат уровней: заголовок и записи фиксированного размера
+# (время, тип, x, y, скорость, скорость вращения), отсортированные по времени.
+# Уровень читается одним чтением файла, записи распаковываются только когда наступает их время.
+#
+# компиляция csv-файлов уровней:
+#     python level_pack.py data/lvl_01.csv data/lvl_02.csv ...
+import os
+import sys
+import csv
+import struct
+
+MAGIC = b"STLV"
+VERSION = 1
+TYPES = ("star", "b_hole", "l_blast", "win")
+# поля, которые обязательны для каждого типа события
+REQUIRED = {"star": ("x", "y", "speed", "rot_spd"), "b_hole": ("x", "y", "speed"), "l_blast": ("x", "y"), "win": ()}
+FIELDS = ("x", "y", "speed", "rot_spd")
+# магия, версия, число событий
+HEADER = struct.Struct("<4sHI")
+RECORD = struct.Struct("<iBhhhh")
+
+
+# событие уровня: (время, тип, x, y, скорость, скорость вращения), пропущенные поля равны 0
+def read_csv(name):
+    events = []
+    with open(name, encoding="utf8") as csvfile:
+        for line, row in enumerate(csv.DictReader(csvfile, delimiter='\t', quotechar='"'), 2):
+            if row["type"] not in TYPES:
+                raise ValueError(f"{name}:{line}: неизвестный тип события {row['type']!r}")
+            for field in REQUIRED[row["type"]]:
+                if not row.get(field):
+                    raise ValueError(f"{name}:{line}: у события {row['type']} нет поля {field}")
+            try:
+                event = (int(row["time"]), row["type"], *[int(row.get(field) or 0) for field in FIELDS])
+            except (TypeError, ValueError):
+                raise ValueError(f"{name}:{line}: значения должны быть целыми числами") from None
+            if not 0 <= event[0] <= 2 ** 31 - 1 or any(not -32768 <= value <= 32767 for value in event[2:]):
+                raise ValueError(f"{name}:{line}: значение вне допустимого диапазона")
+            events.append(event)
+    return sorted(events, key=lambda event: event[0])
+
+
+# файл собирается во временном файле и подменяет старый только целиком,
+# поэтому ошибка компиляции не оставляет недописанный .lvl
+def compile_level(name, out):
+    events = read_csv(name)
+    tmp = out + ".tmp"
+    try:
+        with open(tmp, mode="wb") as packed:
+            packed.write(HEADER.pack(MAGIC, VERSION, len(events)))
+            for t, kind, x, y, speed, rot_spd in events:
+                packed.write(RECORD.pack(t, TYPES.index(kind), x, y, speed, rot_spd))
+        os.replace(tmp, out)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# скомпилированный уровень с тем же интерфейсом, что и LevelScript в main.py
+class CompiledLevel:
+    def __init__(self, name):
+        with open(name, mode="rb") as packed:
+            self.buf = packed.read()
+        magic, version, self.count = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION or len(self.buf) != HEADER.size + RECORD.size * self.count:
+            raise ValueError(f"{name}: неизвестный формат уровня")
+        self.cursor = 0
+
+    def __len__(self):
+        return self.count - self.cursor
+
+    def due(self, t):
+        events = []
+        while self.cursor < self.count:
+            event = RECORD.unpack_from(self.buf, HEADER.size + RECORD.size * self.cursor)
+            if event[0] > t:
+                break
+            events.append((event[0], TYPES[event[1]], *event[2:]))
+            self.cursor += 1
+        return events
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("использование: python level_pack.py <уровень.csv> ...")
+        raise SystemExit(1)
+    for csv_name in sys.argv[1:]:
+        compile_level(csv_name, os.path.splitext(csv_name)[0] + ".lvl")
@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
 import os
-import csv
 import math
 import random
+import json
+import queue
+import threading
+import numpy
 import pygame
+from time import perf_counter
+from itertools import count
+from collections import deque, OrderedDict
 from PIL import Image, ImageDraw
+from anim_pack import PackedAnimation
+from level_pack import CompiledLevel, read_csv
+from recording import Recording
 
 # глобальные параметры, функции и объекты для игры
 pygame.init()
@@ -12,18 +21,33 @@ screen_size = (1024, 768)
 screen = pygame.display.set_mode(screen_size)
 screen_rect = (0, 0, screen_size[0], screen_size[1])
 pygame.display.set_caption("STAR THORNS")
+# частота шагов симуляции: вся логика игры считается шагами по 1 / FPS секунды
 FPS = 30
-
-
-# загрузка изображений
-def load_image(name, color_key=None):
+# частота вывода кадров (0 - без ограничения), между шагами симуляции положения сглаживаются
+RENDER_FPS = FPS
+MUSIC = True
+# сбор времени фаз кадра с самого начала (F3 в игре включает его вместе с выводом на экран)
+# и файл .csv или .json, в который статистика сохраняется при выходе
+PROFILE = False
+PROFILE_DUMP = None
+# вывод на экран только изменившихся областей вместо полной перерисовки кадра
+DIRTY_RECTS = False
+# зерно случайных чисел уровня (None - новое при каждом запуске уровня)
+# и папка, в которую сохраняется запись управления каждого сыгранного уровня
+SEED = None
+RECORD_DIR = None
+
+
+# загрузка изображений; opaque - изображение без прозрачности (задний план),
+# оно переводится в формат экрана без альфа-канала и рисуется без смешивания
+def load_image(name, color_key=None, opaque=False):
     fullname = os.path.join('data', name)
     try:
         image = pygame.image.load(fullname)
     except pygame.error as message:
         print('Не удаётся загрузить:', name)
         raise SystemExit(message)
-    image = image.convert_alpha()
+    image = image.convert() if opaque else image.convert_alpha()
     if color_key is not None:
         if color_key == -1:
             color_key = image.get_at((0, 0))
@@ -31,39 +55,176 @@ def load_image(name, color_key=None):
     return image
 
 
-class SpriteGroup(pygame.sprite.Group):
+# хранилище ресурсов: изображения (по имени, colorkey и размеру) и звуки
+# загружаются с диска один раз и затем берутся из памяти, листы спрайтов
+# нарезаются на кадры один раз и отдаются всем объектам одним неизменяемым кортежем
+class Assets:
     def __init__(self):
+        self.images = dict()
+        self.sounds = dict()
+        self.sheets = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def image(self, name, color_key=None, scale=None, opaque=False):
+        key = (name, color_key, scale, opaque)
+        if key in self.images:
+            self.hits += 1
+        else:
+            self.misses += 1
+            image = load_image(name, color_key, opaque)
+            if scale is not None:
+                image = pygame.transform.scale(image, scale)
+            self.images[key] = image
+        return self.images[key]
+
+    def sound(self, name):
+        if name in self.sounds:
+            self.hits += 1
+        else:
+            self.misses += 1
+            fullname = os.path.join('data', name)
+            try:
+                self.sounds[name] = pygame.mixer.Sound(fullname)
+            except pygame.error as message:
+                print('Не удаётся загрузить:', name)
+                raise SystemExit(message)
+        return self.sounds[name]
+
+    def frames(self, sheet, columns, rows):
+        key = (id(sheet), columns, rows)
+        if key in self.sheets:
+            self.hits += 1
+        else:
+            self.misses += 1
+            w, h = sheet.get_width() // columns, sheet.get_height() // rows
+            # лист хранится вместе с кадрами, чтобы его id не достался другой поверхности
+            self.sheets[key] = (sheet, tuple(sheet.subsurface(pygame.Rect(w * i, h * j, w, h))
+                                             for j in range(rows) for i in range(columns)))
+        return self.sheets[key][1]
+
+    # предзагрузка ресурсов сцены, чтобы во время игры не было обращений к диску
+    def preload(self, scene):
+        for args in scene_assets.get(scene, ()):
+            self.image(*args)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "images": len(self.images), "sounds": len(self.sounds), "sheets": len(self.sheets)}
+
+
+# ленивый источник кадров анимации: кадр загружается с диска при первом обращении,
+# prefetch() догружает кадры в фоновом потоке, а при window > 0 в памяти
+# держится только скользящее окно из window кадров начиная с текущего;
+# load(name) - загрузка одного кадра (по умолчанию png из data).
+# Поток один на всё время работы и получает запросы через очередь; ошибка загрузки
+# в нём сохраняется и поднимается в потоке игры при следующем обращении к кадрам
+class LazyFrames:
+    def __init__(self, names, window=0, opaque=False, load=None):
+        self.names = names
+        self.window = window
+        self.opaque = opaque
+        self.load = load if load is not None else lambda name: load_image(name, opaque=self.opaque)
+        self.frames = dict()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = None
+        self.error = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        self.check()
+        with self.lock:
+            frame = self.frames.get(i)
+        if frame is None:
+            frame = self.load(self.names[i])
+            with self.lock:
+                self.frames[i] = frame
+        if self.window:
+            with self.lock:
+                for j in [j for j in self.frames if (j - i) % len(self.names) >= self.window]:
+                    del self.frames[j]
+            self.prefetch(i)
+        return frame
+
+    def prefetch(self, start=0):
+        self.check()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+        self.requests.put(start)
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def work(self):
+        while True:
+            start = self.requests.get()
+            # из накопившихся запросов важен только последний
+            while not self.requests.empty():
+                start = self.requests.get()
+            count = self.window if self.window else len(self.names)
+            try:
+                self.fill([(start + k) % len(self.names) for k in range(count)])
+            except BaseException as error:
+                # load_image сообщает об ошибке через SystemExit, который завершил бы только этот поток
+                self.error = error
+
+    def fill(self, indices):
+        for i in indices:
+            # пришёл новый запрос: окно догружается уже от него
+            if not self.requests.empty():
+                return
+            with self.lock:
+                loaded = i in self.frames
+            if not loaded:
+                frame = self.load(self.names[i])
+                with self.lock:
+                    self.frames[i] = frame
+
+
+# в группе ordered каждый добавленный спрайт получает номер появления seq из общего
+# счётчика spawn_order: по нему Renderer перемешивает спрайты группы с объектами
+# пулов, которые рисуются вместе с ней (звёзды и пули среди врагов)
+class SpriteGroup(pygame.sprite.Group):
+    def __init__(self, name="", ordered=False):
         super().__init__()
+        self.name = name
+        self.ordered = ordered
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        if self.ordered:
+            sprite.seq = next(spawn_order)
 
     def get_event(self, event):
         for sprite in self:
             sprite.get_event(event)
 
 
+# visible = False убирает спрайт из отрисовки, не удаляя его из групп
 class Sprite(pygame.sprite.Sprite):
     def __init__(self, group):
         super().__init__(group)
         self.add(all_sprites)
         self.rect = None
+        self.visible = True
 
 
 class AnimatedSprite(pygame.sprite.Sprite):
     def __init__(self, sheet, columns, rows, x, y, group, anim_speed):
         super().__init__(group)
         self.add(all_sprites)
-        self.frames = []
-        self.cut_sheet(sheet, columns, rows)
+        self.frames = assets.frames(sheet, columns, rows)
         self.cur_frame = 0
         self.image = self.frames[self.cur_frame]
-        self.rect = self.rect.move(x, y)
+        self.rect = self.image.get_rect().move(x, y)
         self.anim_speed = anim_speed
-
-    def cut_sheet(self, sheet, columns, rows):
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // columns, sheet.get_height() // rows)
-        for j in range(rows):
-            for i in range(columns):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                self.frames.append(sheet.subsurface(pygame.Rect(frame_location, self.rect.size)))
+        self.visible = True
 
     def update(self):
         if self.anim_speed != 0:
@@ -73,20 +234,516 @@ class AnimatedSprite(pygame.sprite.Sprite):
             self.image = self.frames[int(self.cur_frame)]
 
 
+# общий кэш поворотов изображения: угол округляется до шага step,
+# для каждого угла один раз строятся повёрнутое изображение, его colorkey и маска;
+# при limit хранится не больше limit углов, давно не использованные вытесняются;
+# keyed=False - у изображения остаётся попиксельная прозрачность: colorkey не ставится
+# (вместо него возвращается None), а маска строится по альфа-каналу
+class RotationCache:
+    def __init__(self, image, step=2, color_key=None, limit=None, keyed=True):
+        self.step = step
+        self.color_key = image.get_at((0, 0)) if color_key is None else color_key
+        self.flags = 0
+        if not keyed:
+            self.color_key = None
+        # полностью непрозрачные изображения хранятся без альфа-канала и с RLE colorkey:
+        # такие поверхности рисуются в разы быстрее, а выглядят так же
+        w, h = image.get_size()
+        if keyed and image.get_colorkey() is None and pygame.mask.from_surface(image, 254).count() == w * h:
+            image = image.convert()
+            image.set_colorkey(self.color_key)
+            self.flags = pygame.RLEACCEL
+        self.orig_im = image
+        self.limit = limit
+        self.cache = dict()
+
+    def get(self, angle):
+        key = int(round(angle / self.step)) * self.step % 360
+        if key in self.cache:
+            if self.limit is not None:
+                self.cache[key] = self.cache.pop(key)
+        else:
+            image = pygame.transform.rotate(self.orig_im, key)
+            if self.color_key is not None:
+                image.set_colorkey(self.color_key, self.flags)
+            self.cache[key] = (image, self.color_key, pygame.mask.from_surface(image))
+            if self.limit is not None and len(self.cache) > self.limit:
+                del self.cache[next(iter(self.cache))]
+        return self.cache[key]
+
+
+# общий банк поворотов кадров листа спрайтов: повёрнутые кадры и их маски хранятся
+# по (номер кадра, угол) и используются всеми объектами с этим листом
+class RotationBank:
+    def __init__(self, frames, step=1, limit=None):
+        self.frames = [RotationCache(frame, step, limit=limit) for frame in frames]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get(self, i, angle):
+        return self.frames[i].get(angle)
+
+
+# общий кэш масштабированных копий для пульсирующих изображений: коэффициент масштаба
+# округляется до step, поэтому периодическая пульсация проходит по небольшому набору размеров;
+# когда копии занимают больше limit байт, вытесняются давно не использованные
+class PulseCache:
+    def __init__(self, limit=96 * 1024 * 1024):
+        self.limit = limit
+        self.cache = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def scale(self, image, factor, step=0.0025, size=None):
+        factor = round(factor / step) * step
+        w, h = image.get_size() if size is None else size
+        return self.get(image, (int(w * factor), int(h * factor)))
+
+    def get(self, image, size):
+        key = (id(image), size)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key][1]
+        self.misses += 1
+        scaled = pygame.transform.scale(image, size)
+        # исходное изображение хранится вместе с копией, чтобы его id не достался другому
+        self.cache[key] = (image, scaled)
+        self.bytes += scaled.get_pitch() * scaled.get_height()
+        while self.bytes > self.limit and len(self.cache) > 1:
+            old = self.cache.popitem(last=False)[1][1]
+            self.bytes -= old.get_pitch() * old.get_height()
+        return scaled
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "images": len(self.cache), "bytes": self.bytes}
+
+    def clear(self):
+        self.cache.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+# масштабированные копии одного изображения части босса вместе с масками: изображение
+# обрезается по видимой области (без прозрачных пикселей и colorkey), копии строятся при первом
+# обращении к каждому округлённому масштабу; offset - сдвиг центра копии от центра исходного
+# изображения. Маска берётся из mask_image, если он задан, иначе из самого изображения
+class PulseTable:
+    def __init__(self, image, color_key=None, mask_image=None, step=0.005):
+        self.step = step
+        self.color_key = color_key
+        # маски считаются с тем же colorkey, с которым копии будут рисоваться
+        prev = image.get_colorkey()
+        image.set_colorkey(color_key)
+        visible = pygame.mask.from_surface(image, 0)
+        mask = pygame.mask.from_surface(image if mask_image is None else mask_image)
+        image.set_colorkey(prev)
+        area = visible.get_bounding_rects()
+        area = area[0].unionall(area[1:]) if area else pygame.Rect(0, 0, 1, 1)
+        self.image = image.subsurface(area)
+        self.mask = pygame.Mask(area.size)
+        self.mask.draw(mask, (-area.x, -area.y))
+        self.center = (area.centerx - image.get_width() / 2, area.centery - image.get_height() / 2)
+        self.cache = dict()
+
+    def get(self, factor):
+        key = round(factor / self.step)
+        if key not in self.cache:
+            factor = key * self.step
+            w, h = self.image.get_size()
+            image = pygame.transform.scale(self.image, (int(w * factor), int(h * factor)))
+            if self.color_key is not None:
+                image.set_colorkey(self.color_key)
+            self.cache[key] = (image, self.mask.scale(image.get_size()),
+                               (self.center[0] * factor, self.center[1] * factor))
+        return self.cache[key]
+
+
+# проверка попаданий снарядов раз за кадр после движения всех объектов:
+# прямоугольники всех снарядов собираются в один список, для каждой цели
+# Rect.collidelistall находит пересечения за один вызов, а маски проверяются
+# уже в check_hit игрока и босса
+class Collisions:
+    def __init__(self):
+        self.shots = []
+        self.rects = []
+
+    def check(self):
+        shots = self.shots
+        shots.clear()
+        for obj in enemies_group:
+            if getattr(obj, "hits_player", False):
+                shots.append(obj)
+        shots.extend(stars)
+        self.rects[:] = [obj.rect for obj in shots]
+        if player is not None and player.alive():
+            for i in player.rect.collidelistall(self.rects):
+                if shots[i].alive():
+                    player.check_hit(shots[i])
+            for obj in bullets.query(player.rect):
+                player.check_hit(obj)
+        if boss is not None and boss.alive():
+            for child in boss.children:
+                for i in child.rect.collidelistall(self.rects):
+                    if shots[i].hits_boss and shots[i].alive():
+                        boss.check_hit(shots[i])
+                for obj in bullets.query(child.rect, boss_only=True):
+                    if obj.alive():
+                        boss.check_hit(obj)
+
+
+# тряска камеры: смещение учитывается только при отрисовке кадра
 class Camera:
     def __init__(self):
         self.x = 0
         self.y = 0
 
-    def apply(self, obj):
-        obj.rect.x += self.x
-        obj.rect.y += self.y
+    def offset(self):
+        return self.x, self.y
 
     def update(self, target):
         self.x = target[0]
         self.y = target[1]
 
 
+# очередь отрисовки кадра: изображения всех слоёв собираются в один список, упорядочиваются
+# по номеру слоя и номеру появления seq (при равных порядок добавления сохраняется) и выводятся одним вызовом
+# Surface.blits; скрытые (visible = False), полностью прозрачные и целиком лежащие
+# за пределами area изображения в очередь не попадают, а только учитываются в culled
+class RenderQueue:
+    def __init__(self, area):
+        self.area = pygame.Rect(area)
+        self.items = []
+        self.culled = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+        self.culled = 0
+
+    def push(self, layer, key, image, rect, seq=0):
+        if image.get_alpha() == 0 or not self.area.colliderect(rect):
+            self.culled += 1
+        else:
+            self.items.append((layer, seq, key, image, rect))
+
+    def extend(self, layer, items):
+        for item in items:
+            self.push(layer, *item)
+
+    def sort(self):
+        self.items.sort(key=lambda item: (item[0], item[1]))
+
+    def blits(self):
+        return [(image, rect) for layer, seq, key, image, rect in self.items]
+
+    def submit(self, surface):
+        surface.blits(self.blits(), doreturn=False)
+
+
+# отрисовка кадра: в обычном режиме экран перерисовывается и выводится целиком,
+# в режиме dirty сравниваются изображения, положения и прозрачность объектов с прошлым кадром
+# и перерисовываются и выводятся через display.update только изменившиеся области
+# (прокручивающийся задний план при этом всё равно обновляет весь экран);
+# смещение камеры и сглаживание между шагами симуляции применяются только к объектам мира
+# из группы world, интерфейс остаётся на месте
+class Renderer:
+    def __init__(self, surface, world, dirty=False, max_rects=24, max_jump=200):
+        self.surface = surface
+        self.world = world
+        self.dirty = dirty
+        self.max_rects = max_rects
+        self.max_jump = max_jump
+        self.last = dict()
+        self.prev = dict()
+        self.rects = None
+        self.overlay_rect = None
+        self.queue = RenderQueue(surface.get_rect())
+
+    # запоминание положений перед шагом симуляции для сглаживания
+    def save(self, layers):
+        self.prev.clear()
+        for layer in layers:
+            if isinstance(layer, pygame.sprite.AbstractGroup):
+                for sprite in layer:
+                    self.prev[id(sprite)] = sprite.rect.center
+            else:
+                layer.save()
+
+    # положение каждого объекта на экране: (ключ, изображение, прямоугольник) в очередь кадра;
+    # слой с группой group рисуется под её номером вперемешку с её спрайтами по seq
+    def place(self, layers, offset, alpha):
+        self.queue.clear()
+        for n, layer in enumerate(layers):
+            if not isinstance(layer, pygame.sprite.AbstractGroup):
+                group = getattr(layer, "group", None)
+                self.queue.extend(layers.index(group) if group in layers else n, layer.rects(offset, alpha))
+                continue
+            for sprite in layer:
+                if not getattr(sprite, "visible", True):
+                    self.queue.culled += 1
+                    continue
+                rect = sprite.rect
+                if sprite in self.world:
+                    dx, dy = offset
+                    old = self.prev.get(id(sprite))
+                    if alpha < 1 and old is not None:
+                        mx = rect.centerx - old[0]
+                        my = rect.centery - old[1]
+                        if abs(mx) + abs(my) < self.max_jump:
+                            dx -= round(mx * (1 - alpha))
+                            dy -= round(my * (1 - alpha))
+                    if dx or dy:
+                        rect = rect.move(dx, dy)
+                self.queue.push(n, id(sprite), sprite.image, rect, getattr(sprite, "seq", 0))
+        self.queue.sort()
+
+    def snapshot(self):
+        cur = dict()
+        for n, seq, key, image, rect in self.queue.items:
+            cur[key] = (id(image), tuple(rect), image.get_alpha())
+        return cur
+
+    def changed(self, cur):
+        rects = []
+        for key, state in cur.items():
+            old = self.last.get(key)
+            if old != state:
+                rects.append(pygame.Rect(state[1]))
+                if old is not None:
+                    rects.append(pygame.Rect(old[1]))
+        for key, old in self.last.items():
+            if key not in cur:
+                rects.append(pygame.Rect(old[1]))
+        screen_area = self.surface.get_rect()
+        rects = [rect.clip(screen_area) for rect in rects if rect.colliderect(screen_area)]
+        if len(rects) > self.max_rects:
+            rects = [rects[0].unionall(rects[1:])]
+        return rects
+
+    # offset - смещение камеры, alpha - доля шага симуляции, прошедшая после последнего шага;
+    # оба применяются только при выводе и не меняют положения объектов
+    def draw(self, layers, offset=(0, 0), alpha=1.0):
+        self.place(layers, offset, alpha)
+        profiler.count("drawn", len(self.queue))
+        profiler.count("culled", self.queue.culled)
+        profiler.mark("place")
+        if not self.dirty:
+            self.rects = None
+            self.surface.fill(pygame.Color("black"))
+            self.queue.submit(self.surface)
+            profiler.mark("draw")
+            return
+        cur = self.snapshot()
+        self.rects = self.changed(cur)
+        # место прошлого вывода профилировщика перерисовывается: оверлей мог уменьшиться
+        # или быть выключен, а в режиме dirty его изображение иначе осталось бы на экране
+        if self.overlay_rect is not None:
+            self.rects.append(self.overlay_rect)
+            self.overlay_rect = None
+        self.last = cur
+        profiler.mark("dirty rects")
+        # список для blits строится один раз, а в каждую область выводятся
+        # только пересекающие её изображения
+        blits = self.queue.blits()
+        areas = [rect for image, rect in blits]
+        for rect in self.rects:
+            self.surface.set_clip(rect)
+            self.surface.fill(pygame.Color("black"))
+            self.surface.blits([blits[i] for i in rect.collidelistall(areas)], doreturn=False)
+        self.surface.set_clip(None)
+        profiler.mark("draw")
+
+    def flip(self):
+        if profiler.overlay:
+            rect = profiler.draw(self.surface)
+            self.overlay_rect = rect
+            if self.rects is not None:
+                self.rects.append(rect)
+        if self.rects is None:
+            pygame.display.flip()
+        elif self.rects:
+            pygame.display.update(self.rects)
+        profiler.mark("flip")
+
+
+# профилировщик кадра: время каждой фазы кадра (mark засчитывает время с предыдущей отметки)
+# и число объектов в группах копятся в скользящем окне последних window кадров;
+# время кадра frame - сумма фаз без ожидания (idle), то есть работа, а не ограничение частоты;
+# overlay выводит перцентили поверх игры, dump сохраняет их в csv или json
+class Profiler:
+    def __init__(self, enabled=False, window=300, idle=("wait",)):
+        self.enabled = enabled
+        self.idle = idle
+        self.overlay = False
+        self.window = window
+        self.samples = dict()
+        self.counts = dict()
+        self.frame = dict()
+        self.t = perf_counter()
+        self.frames = 0
+        self.font = None
+        self.text = []
+
+    def reset(self):
+        self.samples.clear()
+        self.counts.clear()
+        self.frame.clear()
+        self.frames = 0
+        self.text = []
+
+    def toggle(self):
+        self.overlay = not self.overlay
+        self.enabled = self.enabled or self.overlay
+
+    def start(self):
+        self.frame.clear()
+        self.t = perf_counter()
+
+    def mark(self, phase):
+        if self.enabled:
+            now = perf_counter()
+            self.frame[phase] = self.frame.get(phase, 0) + now - self.t
+            self.t = now
+
+    def count(self, name, n):
+        if self.enabled:
+            self.counts.setdefault(name, deque(maxlen=self.window)).append(n)
+
+    def end_frame(self, groups=()):
+        if not self.enabled:
+            return
+        for phase, dt in self.frame.items():
+            self.samples.setdefault(phase, deque(maxlen=self.window)).append(dt)
+        self.samples.setdefault("frame", deque(maxlen=self.window)).append(
+            sum(dt for phase, dt in self.frame.items() if phase not in self.idle))
+        for group in groups:
+            self.count(group.name, len(group))
+        self.frame.clear()
+        self.frames += 1
+
+    # фаза: (p50, p95, p99, максимум) в миллисекундах
+    def percentiles(self):
+        res = dict()
+        for phase, values in self.samples.items():
+            values = sorted(values)
+            res[phase] = tuple(values[min(int(len(values) * q), len(values) - 1)] * 1000
+                               for q in (0.5, 0.95, 0.99, 1))
+        return res
+
+    def draw(self, surface):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        if self.frames % 15 == 0 or not self.text:
+            stats = self.percentiles()
+            lines = ["фаза              p50    p95    p99 мс"]
+            lines += [f"{phase:<15}{p50:6.2f} {p95:6.2f} {p99:6.2f}" for phase, (p50, p95, p99, top) in stats.items()]
+            lines += [f"{name:<15}{values[-1]:6d} объектов" for name, values in self.counts.items()]
+            self.text = [self.font.render(line, True, pygame.Color("white"), pygame.Color("black")) for line in lines]
+        rect = pygame.Rect(surface.get_width() - 300, 0, 300, 18 * len(self.text))
+        surface.blits([(line, (rect.x + 4, rect.y + 18 * i)) for i, line in enumerate(self.text)], doreturn=False)
+        return rect
+
+    def dump(self, name):
+        stats = self.percentiles()
+        counts = {group: max(values) for group, values in self.counts.items()}
+        with open(name, mode="w", encoding="utf8") as out:
+            if name.endswith(".json"):
+                json.dump({"frames": self.frames,
+                           "phases": {phase: dict(zip(("p50", "p95", "p99", "max"), values))
+                                      for phase, values in stats.items()},
+                           "max_objects": counts}, out, ensure_ascii=False, indent=2)
+            else:
+                out.write("phase,p50_ms,p95_ms,p99_ms,max_ms\n")
+                for phase, values in stats.items():
+                    out.write(phase + "," + ",".join(f"{value:.4f}" for value in values) + "\n")
+                for group, count in counts.items():
+                    out.write(f"objects {group},{count},,,\n")
+
+
+# игровой цикл с фиксированным шагом: симуляция всегда продвигается шагами по 1000 / fps мс,
+# а кадры выводятся с частотой render_fps (0 - без ограничения); реальное время копится
+# и расходуется целыми шагами, за кадр выполняется не больше max_steps шагов, а остальное
+# отбрасывается, чтобы после зависания игра не пыталась догнать всё пропущенное время
+class GameLoop:
+    def __init__(self, fps, render_fps=0, max_steps=5):
+        self.clock = pygame.time.Clock()
+        self.step = 1000 / fps
+        self.render_fps = render_fps
+        self.max_steps = max_steps
+        self.acc = 0
+
+    # начало сцены: первый кадр выполняет ровно один шаг
+    def reset(self):
+        self.clock.tick()
+        self.acc = self.step
+
+    def steps(self):
+        self.acc += self.clock.tick(self.render_fps)
+        n = int(self.acc // self.step)
+        self.acc -= n * self.step
+        return min(n, self.max_steps)
+
+    def alpha(self):
+        return self.acc / self.step
+
+
+# управление игроком: клавиши хранятся битовой маской, которая читается один раз за шаг
+# симуляции; запись масок по шагам вместе с зерном rng полностью повторяет уровень,
+# при воспроизведении маски берутся из записи, а клавиатура не влияет на игрока
+class Controls:
+    KEYS = (pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT, pygame.K_x)
+    UP, DOWN, LEFT, RIGHT, SLOW = (1 << i for i in range(len(KEYS)))
+
+    def __init__(self):
+        self.keys = 0
+        self.record = None
+        self.replay = None
+        self.cursor = 0
+
+    # начало уровня: выбор зерна и сброс нажатых клавиш
+    def begin(self, lvl):
+        self.keys = 0
+        self.cursor = 0
+        if self.replay is not None:
+            seed = self.replay.seed
+        else:
+            seed = SEED if SEED is not None else random.getrandbits(32)
+            if RECORD_DIR is not None:
+                self.record = Recording(seed, lvl)
+        rng.seed(seed)
+
+    def handle(self, event):
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP) and event.key in self.KEYS:
+            bit = 1 << self.KEYS.index(event.key)
+            if event.type == pygame.KEYDOWN:
+                self.keys |= bit
+            else:
+                self.keys &= ~bit
+
+    def step(self):
+        if self.replay is not None:
+            keys = self.replay.keys[self.cursor] if self.cursor < len(self.replay) else 0
+            self.cursor += 1
+            return keys
+        if self.record is not None:
+            self.record.keys.append(self.keys)
+        return self.keys
+
+    # finished - уровень закончился победой или поражением, а не был прерван
+    def end(self, finished):
+        if self.record is not None:
+            self.record.finished = finished
+            os.makedirs(RECORD_DIR, exist_ok=True)
+            self.record.save(os.path.join(RECORD_DIR, f"lvl_0{self.record.lvl}_{self.record.seed}.rec"))
+            self.record = None
+
+
 # переход от сцены к сцене
 class FadeTransition(pygame.sprite.Sprite):
     def __init__(self, image, spd):
@@ -123,47 +780,81 @@ class FadeTransition(pygame.sprite.Sprite):
         self.image.set_alpha(int(a))
 
 
-# части заднего плана
-class BackGroundPart(Sprite):
-    def __init__(self, image):
-        super().__init__(sprite_group)
-        self.image = image
-        self.rect = self.image.get_rect()
-
+# прокручиваемый слой заднего плана: кадр рисуется двумя копиями одна над другой,
+# blit обрезает их по экрану, поэтому вместе они стоят как один полноэкранный blit,
+# а непрозрачные кадры (opaque при загрузке) копируются без смешивания;
+# depth - доля скорости прокрутки для параллакса, anim_speed - скорость смены кадров
+class ScrollLayer:
+    def __init__(self, frames, depth=1.0, anim_speed=0):
+        self.frames = frames
+        self.depth = depth
+        self.anim_speed = anim_speed
+        self.cur_frame = 0
+        # кадр берётся из frames только при смене номера, а не на каждом шаге
+        self.image = frames[0]
+        self.lim = self.image.get_height()
+        self.y = 0
+        self.py = 0
 
+    def update(self, vel):
+        self.y += vel * self.depth / FPS
+        self.y %= self.lim
+        if self.anim_speed != 0:
+            i = int(self.cur_frame)
+            self.cur_frame += self.anim_speed / FPS
+            if self.cur_frame >= len(self.frames):
+                self.cur_frame -= (int(self.cur_frame) // len(self.frames)) * len(self.frames)
+            if int(self.cur_frame) != i:
+                self.image = self.frames[int(self.cur_frame)]
+
+    def save(self):
+        self.py = self.y
+
+    def rects(self, offset=(0, 0), alpha=1.0):
+        y = self.y
+        if y < self.py:
+            # за шаг слой перешёл через край изображения
+            y += self.lim
+        y = int(self.py + (y - self.py) * alpha) % self.lim
+        w = self.image.get_width()
+        return [((id(self), 0), self.image, (offset[0], offset[1] + y, w, self.lim)),
+                ((id(self), 1), self.image, (offset[0], offset[1] + y - self.lim, w, self.lim))]
+
+
+# задний план - отдельный слой Renderer, как звёзды и пули: основной слой и слои
+# параллакса parallax - пары (кадры, depth), которые рисуются поверх от дальних к ближним;
+# у ближних слоёв прозрачные места задаются colorkey, чтобы они тоже рисовались без смешивания
 class BackGround:
-    def __init__(self, image, vel):
-        self.pic1 = BackGroundPart(image)
-        self.pic2 = BackGroundPart(image)
-        self.y = 0
-        self.lim = screen_size[0]
+    def __init__(self, image, vel, parallax=()):
+        self.name = "background"
+        self.layers = [ScrollLayer((image,))] + [ScrollLayer(frames, depth) for frames, depth in parallax]
         self.vel = vel
 
+    def __len__(self):
+        return len(self.layers)
+
     def update(self):
-        self.y += self.vel / FPS
-        self.y %= self.lim
-        self.pic1.rect.y = int(self.y)
-        self.pic2.rect.y = int(self.y) - self.lim
+        for layer in self.layers:
+            layer.update(self.vel)
+
+    def save(self):
+        for layer in self.layers:
+            layer.save()
+
+    def rects(self, offset=(0, 0), alpha=1.0):
+        items = []
+        for layer in self.layers:
+            items.extend(layer.rects(offset, alpha))
+        return items
 
     def kill(self):
-        self.pic1.kill()
-        self.pic2.kill()
+        self.layers.clear()
 
 
 class BossBackGround(BackGround):
-    def __init__(self, vel, anim_speed):
-        super().__init__(bgrnd_boss_frames[0], vel)
-        self.frames = bgrnd_boss_frames
-        self.anim_speed = anim_speed
-        self.cur_frame = 0
-
-    def update(self):
-        super().update()
-        self.cur_frame += self.anim_speed / FPS
-        if self.cur_frame >= len(self.frames):
-            self.cur_frame -= (int(self.cur_frame) // len(self.frames)) * len(self.frames)
-        self.pic1.image = self.frames[int(self.cur_frame)]
-        self.pic2.image = self.frames[int(self.cur_frame)]
+    def __init__(self, vel, anim_speed, parallax=()):
+        super().__init__(bgrnd_boss_frames[0], vel, parallax)
+        self.layers[0] = ScrollLayer(bgrnd_boss_frames, anim_speed=anim_speed)
 
 
 # классы для начального экрана игры
@@ -179,8 +870,8 @@ class Logo(Sprite):
 
     def update(self):
         if not self.stop:
-            self.image = pygame.transform.scale(self.orig_im, (int(self.xsize * (math.sin(time / 1000) + 10) / 10),
-                                                               int(self.ysize * (math.sin(time / 1000) + 10) / 10)))
+            self.image = pulse_cache.scale(self.orig_im, (math.sin(time / 1000) + 10) / 10,
+                                           size=(self.xsize, self.ysize))
             self.rect = self.image.get_rect()
             self.rect.centerx = screen_size[0] // 2
             self.rect.centery = screen_size[1] // 2
@@ -209,7 +900,7 @@ class Instructions(Sprite):
 class CurLevelText(Sprite):
     def __init__(self):
         super().__init__(sprite_group)
-        self.image = load_image("ttl_current_level.png", -1)
+        self.image = assets.image("ttl_current_level.png", -1)
         self.rect = self.image.get_rect()
         self.image.set_alpha(0)
         self.rect.centerx = screen_size[0] // 4 * 3 - 100
@@ -218,7 +909,7 @@ class CurLevelText(Sprite):
 
 class CurLevel(AnimatedSprite):
     def __init__(self):
-        super().__init__(load_image("ttl_numbers.png", -1), 5, 2, 0, 0, sprite_group, 0)
+        super().__init__(assets.image("ttl_numbers.png", -1), 5, 2, 0, 0, sprite_group, 0)
         self.image = self.frames[int(data_dict["lvl"]) - 1]
         self.color_key = self.image.get_at((0, 0))
         self.image = pygame.transform.scale(self.image, (25, 25))
@@ -252,9 +943,16 @@ class Player(AnimatedSprite):
         self.inv = False
         self.inv_t = inv_t
         self.hit_t = -inv_t
+        # неуязвимость без ограничения по времени (прогон уровней без окна с --god)
+        self.god = False
         self.shake_dist = 0
         self.slow = False
 
+    def control(self, keys):
+        self.movex = bool(keys & Controls.RIGHT) - bool(keys & Controls.LEFT)
+        self.movey = bool(keys & Controls.DOWN) - bool(keys & Controls.UP)
+        self.slow = bool(keys & Controls.SLOW)
+
     def update(self):
         super().update()
         self.n_x += self.vel * self.movex / FPS / (2 if self.slow else 1)
@@ -281,52 +979,51 @@ class Player(AnimatedSprite):
                 self.inv = False
         else:
             self.image.set_alpha(255)
-        camera.update((random.randint(int(-self.shake_dist), int(self.shake_dist)),
-                       random.randint(int(-self.shake_dist), int(self.shake_dist))))
+        camera.update((rng.randint(int(-self.shake_dist), int(self.shake_dist)),
+                       rng.randint(int(-self.shake_dist), int(self.shake_dist))))
         if self.shake_dist > 0:
             self.shake_dist -= 20 / FPS
         else:
             self.shake_dist = 0
 
+    # маска игрока центрирована по его прямоугольнику, маска снаряда совпадает с его изображением
     def check_hit(self, projectile):
-        offset_x = int(projectile.rect.centerx - self.rect.centerx)
-        offset_y = int(projectile.rect.centery - self.rect.centery)
-        if self.mask.overlap(self.mask, (offset_x, offset_y)):
-            if not self.inv and self.alive():
-                global state, next_state, fade
-                if fade.fade == 0:
-                    # уменьшить кол-во оставшихся жизней
-                    if health_bar.health > 1:
-                        health_bar.health -= 1
-                        pygame.mixer.Sound.play(hit_sound)
-                        self.inv = True
-                        self.hit_t = time
-                        self.shake_dist = 20
-                    else:
-                        # в случае поражения
-                        health_bar.health = 0
-                        state = "game_over"
-                        next_state = "game"
-                        fade.fade = 0
-                        fade.image.set_alpha(0)
-                projectile.kill()
+        mask_rect = self.mask.get_rect(center=self.rect.center)
+        if not mask_rect.colliderect(projectile.rect):
+            return
+        offset_x = projectile.rect.x - mask_rect.x
+        offset_y = projectile.rect.y - mask_rect.y
+        if self.mask.overlap(projectile.mask, (offset_x, offset_y)):
+            self.hit(projectile)
+
+    def hit(self, projectile):
+        if not self.inv and not self.god and self.alive():
+            global state, next_state, fade
+            if fade.fade == 0:
+                # уменьшить кол-во оставшихся жизней
+                if health_bar.health > 1:
+                    health_bar.health -= 1
+                    pygame.mixer.Sound.play(hit_sound)
+                    self.inv = True
+                    self.hit_t = time
+                    self.shake_dist = 20
+                else:
+                    # в случае поражения
+                    health_bar.health = 0
+                    state = "game_over"
+                    next_state = "game"
+                    fade.fade = 0
+                    fade.image.set_alpha(0)
+        projectile.kill()
 
 
 class HealthBar(pygame.sprite.Sprite):
     def __init__(self, sheet, columns, rows, x, y, group):
         super().__init__(group)
-        self.frames = []
-        self.cut_sheet(sheet, columns, rows)
+        self.frames = assets.frames(sheet, columns, rows)
         self.health = 5
         self.image = self.frames[5 - self.health]
-        self.rect = self.rect.move(x, y)
-
-    def cut_sheet(self, sheet, columns, rows):
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // columns, sheet.get_height() // rows)
-        for j in range(rows):
-            for i in range(columns):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                self.frames.append(sheet.subsurface(pygame.Rect(frame_location, self.rect.size)))
+        self.rect = self.image.get_rect().move(x, y)
 
     def update(self):
         self.image = self.frames[5 - self.health]
@@ -343,28 +1040,38 @@ class Border(Sprite):
             self.image = pygame.Surface([x2 - x1, 1])
             self.rect = pygame.Rect(x1, y1, x2 - x1, 1)
         self.image.set_alpha(0)
+        self.visible = False
+
 
+# атакующая звезда, спукающаяся вниз и затем разрывающаяся; лёгкая сущность пула stars:
+# состояние хранится в __slots__, а не в словаре спрайта, группы pygame не используются
+class Star:
+    __slots__ = ("pool", "seq", "live", "image", "color_key", "mask", "rect", "boss_fight", "hits_player", "hits_boss",
+                 "x", "y", "px", "py", "vel", "rot_spd", "rot", "accel", "rot_accel")
 
-# атакующая звезда, спукающаяся вниз и затем разрывающаяся
-class Star(Sprite):
     def __init__(self, x, y, vel, rot_spd):
-        super().__init__(enemies_group)
-        scene_objects.append(self)
-        self.image = star_image
-        self.color_key = star_image.get_at((0, 0))
-        self.mask = pygame.mask.from_surface(self.image)
-        self.rect = self.image.get_rect()
+        self.pool = None
+        self.reset(x, y, vel, rot_spd)
+
+    def reset(self, x, y, vel, rot_spd):
+        self.live = True
+        self.image, self.color_key, self.mask = star_rotations.get(0)
         self.boss_fight = data_dict["lvl"] == str(levels)
+        self.hits_player = True
+        self.hits_boss = self.boss_fight
         self.x = x
         self.y = y if not self.boss_fight else screen_size[1] - y
-        self.rect.centerx = self.x
-        self.rect.centery = self.y
+        self.rect = self.image.get_rect(center=(self.x, self.y))
+        self.px, self.py = self.rect.center
         self.vel = vel
         self.rot_spd = rot_spd
         self.rot = 0
         self.accel = self.vel / 2.5
         self.rot_accel = self.rot_spd
 
+    def alive(self):
+        return self.live
+
     # кружение и движение вниз
     def update(self):
         # кружение и движение вниз
@@ -384,57 +1091,242 @@ class Star(Sprite):
                 pygame.mixer.Sound.stop(star_explode_sound)
                 pygame.mixer.Sound.play(star_explode_sound)
                 for i in range(5):
-                    ShotPiece(self.x, self.y, 400, i * 72 + self.rot, star_piece_image)
+                    bullets.spawn(self.x, self.y, 400, i * 72 + self.rot, star_piece_image)
                 self.kill()
-        # применение изменений
-        self.image = pygame.transform.rotate(star_image, self.rot)
-        self.image.set_colorkey(self.color_key)
-        self.mask = pygame.mask.from_surface(self.image)
-        self.rect = self.image.get_rect()
-        self.rect.centerx = int(self.x)
-        self.rect.centery = int(self.y)
-        player.check_hit(self)
-        if self.boss_fight:
-            boss.check_hit(self)
+        # применение изменений (повёрнутые изображения и маски берутся из общего кэша)
+        self.image, self.color_key, self.mask = star_rotations.get(self.rot)
+        self.rect = self.image.get_rect(center=(int(self.x), int(self.y)))
 
+    def kill(self):
+        if self.live:
+            self.live = False
+            self.pool.release(self)
+
+
+# вражеские пули, которые выпускают другие объекты: все пули хранятся в массивах numpy
+# и двигаются одним векторным шагом, изображения берутся из общих кэшей поворотов;
+# group - группа, вместе с которой пули рисуются в порядке появления
+class BulletPool:
+    def __init__(self, capacity=256, group=None):
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.px = numpy.zeros(capacity)
+        self.py = numpy.zeros(capacity)
+        self.vel = numpy.zeros(capacity)
+        self.rot = numpy.zeros(capacity)
+        self.w = numpy.zeros(capacity)
+        self.h = numpy.zeros(capacity)
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        self.hits_boss = numpy.zeros(capacity, dtype=bool)
+        self.seq = numpy.zeros(capacity, dtype=numpy.int64)
+        self.images = [None] * capacity
+        self.masks = [None] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        self.rotations = dict()
+        self.high = 0
+        self.name = "bullets"
+        self.group = group
+
+    def __len__(self):
+        return len(self.alive) - len(self.free)
+
+    def grow(self):
+        n = len(self.alive)
+        for name in ("x", "y", "px", "py", "vel", "rot", "w", "h", "alive", "hits_boss", "seq"):
+            setattr(self, name, numpy.concatenate((getattr(self, name), numpy.zeros_like(getattr(self, name)))))
+        self.images += [None] * n
+        self.masks += [None] * n
+        self.free = list(range(2 * n - 1, n - 1, -1)) + self.free
+
+    def spawn(self, x, y, vel, rot, image):
+        if not self.free:
+            self.grow()
+        i = self.free.pop()
+        if id(image) not in self.rotations:
+            self.rotations[id(image)] = RotationCache(image)
+        self.images[i], color_key, self.masks[i] = self.rotations[id(image)].get(rot)
+        self.w[i], self.h[i] = self.images[i].get_size()
+        self.x[i] = self.px[i] = x
+        self.y[i] = self.py[i] = y
+        self.vel[i] = vel
+        self.rot[i] = rot / 360 * 2 * math.pi
+        self.alive[i] = True
+        self.hits_boss[i] = data_dict["lvl"] == str(levels)
+        self.seq[i] = next(spawn_order)
+        self.high = max(self.high, len(self))
+        return i
+
+    def remove(self, i):
+        if self.alive[i]:
+            self.alive[i] = False
+            self.images[i] = self.masks[i] = None
+            self.free.append(i)
 
-# вражеские пули, которые выпускают другие объекты
-class ShotPiece(Sprite):
-    def __init__(self, x, y, vel, rot, image):
-        super().__init__(enemies_group)
-        scene_objects.append(self)
-        self.image = pygame.transform.rotate(image, rot)
-        self.color_key = image.get_at((0, 0))
-        self.image.set_colorkey(self.color_key)
-        self.mask = pygame.mask.from_surface(self.image)
-        self.rect = self.image.get_rect()
-        self.rect.centerx = x
-        self.rect.centery = y
-        self.x = x
-        self.y = y
-        self.vel = vel
-        self.rot = rot / 360 * 2 * math.pi
-        self.boss_fight = data_dict["lvl"] == str(levels)
+    def update(self):
+        alive = self.alive
+        self.vel[alive] += 800 / FPS
+        self.x[alive] -= numpy.sin(self.rot[alive]) * self.vel[alive] / FPS
+        self.y[alive] -= numpy.cos(self.rot[alive]) * self.vel[alive] / FPS
+        # пули, вылетевшие за экран, удаляются
+        outside = alive & ((self.x + self.w / 2 < 0) | (self.x - self.w / 2 > screen_size[0]) |
+                           (self.y + self.h / 2 < 0) | (self.y - self.h / 2 > screen_size[1]))
+        for i in numpy.flatnonzero(outside):
+            self.remove(i)
+
+    # пули, прямоугольники которых пересекают rect
+    def query(self, rect, boss_only=False):
+        near = self.alive & (numpy.abs(self.x - rect.centerx) < (self.w + rect.w) / 2) & \
+            (numpy.abs(self.y - rect.centery) < (self.h + rect.h) / 2)
+        if boss_only:
+            near &= self.hits_boss
+        return [Bullet(self, i) for i in numpy.flatnonzero(near)]
+
+    # положения перед шагом симуляции для сглаживания при отрисовке
+    def save(self):
+        self.px[:] = self.x
+        self.py[:] = self.y
+
+    def positions(self, offset, alpha):
+        idx = numpy.flatnonzero(self.alive)
+        x = self.px[idx] + (self.x[idx] - self.px[idx]) * alpha
+        y = self.py[idx] + (self.y[idx] - self.py[idx]) * alpha
+        left = (x - self.w[idx] // 2).astype(int) + offset[0]
+        top = (y - self.h[idx] // 2).astype(int) + offset[1]
+        return idx, left.tolist(), top.tolist()
+
+    def draw(self, surface, offset=(0, 0), alpha=1.0):
+        idx, left, top = self.positions(offset, alpha)
+        surface.blits([(self.images[i], (lx, ty)) for i, lx, ty in zip(idx, left, top)], doreturn=False)
+
+    def kill(self):
+        for i in numpy.flatnonzero(self.alive):
+            self.remove(i)
+
+    # ключ, изображение, прямоугольник и номер появления каждой живой пули для Renderer
+    def rects(self, offset=(0, 0), alpha=1.0):
+        idx, left, top = self.positions(offset, alpha)
+        w = self.w[idx].astype(int).tolist()
+        h = self.h[idx].astype(int).tolist()
+        seq = self.seq[idx].tolist()
+        return [((id(self), i), self.images[i], (lx, ty, wi, hi), si)
+                for i, lx, ty, wi, hi, si in zip(idx.tolist(), left, top, w, h, seq)]
+
+    def stats(self):
+        return {"live": len(self), "free": len(self.free), "high_water": self.high}
+
+    # начало нового замера: пики и счётчики считаются заново от текущего состояния
+    def reset_stats(self):
+        self.high = len(self)
+
+
+# пул сущностей - единственный реестр живых объектов одного вида: убитые объекты
+# не выбрасываются, а переиспользуются через reset(), в свободном списке хранится
+# не больше size объектов. Для лёгких сущностей без групп pygame (звёзды) пул сам
+# служит слоем Renderer: обновляет объекты, запоминает положения для сглаживания
+# и отдаёт все изображения одним списком для Surface.blits; такой слой с group рисуется
+# вместе с этой группой, объекты получают номер появления seq
+class EntityPool:
+    def __init__(self, cls, size=64, name="", group=None):
+        self.cls = cls
+        self.size = size
+        self.name = name
+        self.group = group
+        self.free = []
+        self.active = dict()
+        self.high = 0
+        self.created = 0
+        self.reused = 0
+
+    def __len__(self):
+        return len(self.active)
+
+    def __iter__(self):
+        return iter(self.active.values())
+
+    def get(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            self.reused += 1
+        else:
+            obj = self.cls(*args)
+            obj.pool = self
+            self.created += 1
+        if self.group is not None:
+            obj.seq = next(spawn_order)
+        self.active[id(obj)] = obj
+        self.high = max(self.high, len(self.active))
+        return obj
+
+    def release(self, obj):
+        if self.active.pop(id(obj), None) is not None and len(self.free) < self.size:
+            self.free.append(obj)
 
     def update(self):
-        self.vel += 800 / FPS
-        self.x -= math.sin(self.rot) * self.vel / FPS
-        self.y -= math.cos(self.rot) * self.vel / FPS
-        if not self.rect.colliderect(screen_rect):
-            self.kill()
-        self.rect.centerx = int(self.x)
-        self.rect.centery = int(self.y)
-        player.check_hit(self)
-        if self.boss_fight:
-            boss.check_hit(self)
+        for obj in list(self.active.values()):
+            obj.update()
+
+    def save(self):
+        for obj in self.active.values():
+            obj.px, obj.py = obj.rect.center
+
+    # ключ, изображение, прямоугольник и номер появления каждого объекта для Renderer
+    def rects(self, offset=(0, 0), alpha=1.0):
+        k = 1 - alpha
+        items = []
+        for obj in self.active.values():
+            rect = obj.rect
+            dx = offset[0] - round((rect.centerx - obj.px) * k)
+            dy = offset[1] - round((rect.centery - obj.py) * k)
+            items.append((id(obj), obj.image, rect.move(dx, dy), obj.seq if self.group is not None else 0))
+        return items
+
+    def draw(self, surface, offset=(0, 0), alpha=1.0):
+        surface.blits([(item[1], item[2]) for item in self.rects(offset, alpha)], doreturn=False)
+
+    def kill(self):
+        for obj in list(self.active.values()):
+            obj.kill()
+
+    def stats(self):
+        return {"live": len(self.active), "free": len(self.free), "high_water": self.high,
+                "created": self.created, "reused": self.reused}
+
+    def reset_stats(self):
+        self.high = len(self.active)
+        self.created = 0
+        self.reused = 0
+
+
+# отдельная пуля из BulletPool с интерфейсом спрайта для check_hit игрока и босса
+class Bullet:
+    def __init__(self, pool, i):
+        self.pool = pool
+        self.i = i
+        self.image = pool.images[i]
+        self.mask = pool.masks[i]
+        self.rect = self.image.get_rect()
+        self.rect.centerx = int(pool.x[i])
+        self.rect.centery = int(pool.y[i])
+
+    def alive(self):
+        return bool(self.pool.alive[self.i])
+
+    def kill(self):
+        self.pool.remove(self.i)
 
 
 class BlackHole(Sprite):
+    pool = None
+
     def __init__(self, x, y, spd):
         super().__init__(enemies_group)
-        scene_objects.append(self)
-        ref = Image.open("data/blackhole_generator.png")
-        self.pix = ref.load()
+        self.fx = None
+        self.reset(x, y, spd)
+
+    def reset(self, x, y, spd):
+        self.add(enemies_group, all_sprites)
+        self.cur_frame = 0
         self.x = x
         self.y = y
         self.spd = spd
@@ -447,7 +1339,10 @@ class BlackHole(Sprite):
         self.rect = self.image.get_rect()
         self.rect.centerx = int(self.x)
         self.rect.centery = int(self.y)
-        self.fx = BlackHoleFX(self)
+        if self.fx is None:
+            self.fx = BlackHoleFX(self)
+        else:
+            self.fx.reset()
 
     def update(self):
         self.offset()
@@ -463,17 +1358,10 @@ class BlackHole(Sprite):
         self.pull()
 
     def offset(self):
-        p_temp = self.pix[0, 0]
-        for j in range(50 - 1):
-            self.pix[0, j] = self.pix[0, j + 1]
-        self.pix[0, -1] = p_temp
+        self.cur_frame = (self.cur_frame + 1) % len(blackhole_frames)
 
     def make_blackhole(self):
-        img = Image.new("RGB", (151, 151), (0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        for i in range(49, -1, -1):
-            draw.ellipse(((49 - i) * 3, (49 - i) * 3, i * 3 + 1, i * 3 + 1), fill=self.pix[0, i], width=1)
-        self.image = pygame.transform.scale(pygame.image.fromstring(img.tobytes(), img.size, img.mode),
+        self.image = pygame.transform.scale(blackhole_frames.get(self.cur_frame),
                                             (int((self.alph / 255 * 150 + 1) * (
                                                         math.sin(time / 50) + 10) / 10),
                                             int((self.alph / 255 * 150 + 1) * (
@@ -484,12 +1372,12 @@ class BlackHole(Sprite):
         self.image.set_colorkey(self.color_key)
 
     def pull(self):
-        if not player.inv:
+        if not player.inv and not player.god:
             d_x = player.x - self.x
             d_y = player.y - self.y
             d = math.sqrt(d_x ** 2 + d_y ** 2)
             if d <= self.image.get_size()[0] / 2:
-                player.check_hit(self)
+                player.hit(self)
             else:
                 vel = (self.alph / 17 * 3) ** 3 / d
                 vel_x = vel * d_x / d
@@ -498,25 +1386,68 @@ class BlackHole(Sprite):
                 player.n_y -= vel_y / FPS
 
     def kill(self):
+        if self.pool is not None and self.alive():
+            self.pool.release(self)
         self.fx.kill()
         super().kill()
 
 
+# общий набор кадров чёрной дыры: цвета колец берутся из столбца blackhole_generator.png
+# и сдвигаются на один шаг за кадр, поэтому палитра периодична и все кадры строятся один раз
+# при загрузке игры, а не при появлении первой чёрной дыры посреди уровня
+class BlackHoleFrames:
+    def __init__(self, name, size=151):
+        self.name = name
+        self.size = size
+        self.frames = []
+        self.build()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def build(self):
+        try:
+            ref = Image.open(os.path.join('data', self.name)).convert("RGB")
+        except OSError as message:
+            print('Не удаётся загрузить:', self.name)
+            raise SystemExit(message)
+        colors = [ref.getpixel((0, j)) for j in range(ref.size[1])]
+        n = len(colors)
+        for k in range(n):
+            img = Image.new("RGB", (self.size, self.size), (0, 0, 0))
+            draw = ImageDraw.Draw(img)
+            # кольца рисуются от внешнего к внутреннему, вырожденные прямоугольники пропускаются
+            for i in range(n - 1, (n - 1) // 2, -1):
+                draw.ellipse(((n - 1 - i) * 3, (n - 1 - i) * 3, i * 3 + 1, i * 3 + 1),
+                             fill=colors[(i + k) % n], width=1)
+            self.frames.append(pygame.image.fromstring(img.tobytes(), img.size, img.mode).convert())
+
+    def get(self, i):
+        return self.frames[i % len(self.frames)]
+
+
 class BlackHoleFX(Sprite):
     def __init__(self, blackhole):
         super().__init__(enemies_group)
         self.b_hole = blackhole
-        self.orig_im = load_image("blackhole_clouds.png")
+        self.orig_im = assets.image("blackhole_clouds.png")
+        self.reset()
+
+    def reset(self):
+        self.add(enemies_group, all_sprites)
         self.image = self.orig_im
         self.color_key = self.image.get_at((0, 0))
         self.rect = self.image.get_rect()
         self.rect.centerx = self.b_hole.x
         self.rect.centery = self.b_hole.y
 
+    # поворот не кэшируется: размер и прозрачность меняются каждый шаг вместе с alph,
+    # поэтому пары (размер, угол) почти не повторяются (на уровнях 4 и 5 из 2187 и 4930
+    # поворотов различных 1959 и 4141), а общая повёрнутая копия не может хранить
+    # свою прозрачность для каждой чёрной дыры
     def update(self):
-        self.image = pygame.transform.scale(self.orig_im, (int(self.b_hole.alph ** 2 / 255 + 1),
-                                                           int(self.b_hole.alph ** 2 / 255 + 1)))
-        self.image = pygame.transform.rotate(self.image, int(time / 2))
+        size = int(self.b_hole.alph ** 2 / 255 + 1)
+        self.image = pygame.transform.rotate(pulse_cache.get(self.orig_im, (size, size)), int(time / 2))
         self.image.set_alpha(self.b_hole.alph // 2)
         self.image.set_colorkey(self.color_key)
         self.rect = self.image.get_rect()
@@ -525,37 +1456,43 @@ class BlackHoleFX(Sprite):
 
 
 class LaserBlaster(AnimatedSprite):
+    pool = None
+
     def __init__(self, x, y):
         super().__init__(laser_blaster_anim_sheet, 3, 3, x, y, enemies_group, 0)
-        scene_objects.append(self)
+        self.handle = None
+        self.reset(x, y)
+
+    def reset(self, x, y):
+        self.add(enemies_group, all_sprites)
+        self.cur_frame = 0
+        self.anim_speed = 0
         self.x = x
         self.y = y
         self.rot = 0
-        self.image = laser_blaster_image
-        self.orig_im = laser_blaster_image
-        self.mask = pygame.mask.from_surface(self.image)
+        self.image, color_key, self.mask = laser_blaster_aims.get(0)
         self.rect = self.image.get_rect()
         self.rect.centerx = int(self.x)
         self.rect.centery = int(self.y)
         self.state = "appear"
-        self.handle = LaserBlasterHandle(self)
+        self.hits_player = True
+        self.hits_boss = False
+        if self.handle is None:
+            self.handle = LaserBlasterHandle(self)
+        else:
+            self.handle.reset()
 
     def update(self):
-        self.mask = pygame.mask.from_surface(self.image)
         if self.state == "appear":
             self.appear()
             self.aim()
             self.rect.centerx = int(self.x)
             self.rect.centery = int(self.y)
-            player.check_hit(self)
         elif self.state == "shoot":
             self.shoot()
-            player.check_hit(self)
         else:
             super().update()
-            self.image = pygame.transform.rotate(self.frames[int(self.cur_frame)], int(self.rot))
-            self.image.set_colorkey(self.image.get_at((0, 0)))
-            self.mask = pygame.mask.from_surface(self.image)
+            self.image, color_key, self.mask = laser_blaster_rotations.get(int(self.cur_frame), int(self.rot))
             self.rect = self.image.get_rect()
             if int(self.cur_frame) == len(self.frames) - 1:
                 self.anim_speed = 0
@@ -583,14 +1520,13 @@ class LaserBlaster(AnimatedSprite):
             ang_r = math.asin(b / c)
             ang_d = ang_r / math.pi * 180
             self.rot = ang_d if a <= 0 else 180 - ang_d
-            self.image = pygame.transform.rotate(self.orig_im, int(self.rot))
-            self.mask = pygame.mask.from_surface(self.image)
+            self.image, color_key, self.mask = laser_blaster_aims.get(int(self.rot))
             self.rect = self.image.get_rect()
 
     def shoot(self):
         pygame.mixer.Sound.stop(laser_sound)
         pygame.mixer.Sound.play(laser_sound)
-        ShotPiece(self.x, self.y, 1000, self.rot - 90, pygame.transform.scale(load_image("laser_shot.png"), (46, 46)))
+        bullets.spawn(self.x, self.y, 1000, self.rot - 90, assets.image("laser_shot.png", scale=(46, 46)))
         self.anim_speed = 24
         self.state = "disappear"
 
@@ -609,9 +1545,10 @@ class LaserBlaster(AnimatedSprite):
                 return
         self.rect.centerx = int(self.x)
         self.rect.centery = int(self.y)
-        player.check_hit(self)
 
     def kill(self):
+        if self.pool is not None and self.alive():
+            self.pool.release(self)
         self.handle.kill()
         super().kill()
 
@@ -620,6 +1557,10 @@ class LaserBlasterHandle(Sprite):
     def __init__(self, laser_blaster):
         super().__init__(enemies_group)
         self.blstr = laser_blaster
+        self.reset()
+
+    def reset(self):
+        self.add(enemies_group, all_sprites)
         if self.blstr.x > screen_size[0] - 100:
             self.image = pygame.transform.flip(laser_blaster_handle_image, True, False)
         else:
@@ -649,13 +1590,14 @@ class Boss(AnimatedSprite):
         self.ysize = self.rect.h
         self.children = [Engine(boss_engine1, boss_engine1_inv, boss_engine1_dead),
                          Engine(boss_engine2, boss_engine2_inv, boss_engine2_dead), BadGuy()]
+        # таблицы пульсации для каждого изображения частей: обычного, неуязвимости, разрушения, без щита
+        self.tables = dict()
 
     def update(self):
         self.sin_pulse(self, self.orig_im)
         self.children[2].cur_frame += self.children[2].local_anim_speed / FPS
         self.children[2].cur_frame %= len(self.children[2].frames)
         self.children[2].image = self.children[2].frames[int(self.children[2].cur_frame)]
-        self.children[2].image.set_colorkey(self.children[2].color_key)
         for child in self.children:
             self.sin_pulse(child, child.orig_im if child != self.children[2] else child.image)
         if fade.fade == 0 and self.children[2].health == 0:
@@ -665,15 +1607,15 @@ class Boss(AnimatedSprite):
             fade.image = white
             fade.image.set_alpha(0)
 
+    # все части пульсируют с одним масштабом, изображение и маска берутся из таблицы
     def sin_pulse(self, part, orig_im):
-        part.image = pygame.transform.scale(orig_im,
-                                            (int(part.xsize * (math.sin(time / 1000) / 2 + 20.5) / 20),
-                                             int(part.ysize * (math.sin(time / 1000) / 2 + 20.5) / 20)))
-        part.rect = part.image.get_rect()
+        if id(orig_im) not in self.tables:
+            self.tables[id(orig_im)] = PulseTable(orig_im, getattr(part, "color_key", None),
+                                                  getattr(part, "mask_im", None))
+        part.image, mask, (dx, dy) = self.tables[id(orig_im)].get((math.sin(time / 1000) / 2 + 20.5) / 20)
         if part != self:
-            part.image.set_colorkey(part.color_key)
-        part.rect.centerx = part.x
-        part.rect.centery = part.y
+            part.mask = mask
+        part.rect = part.image.get_rect(center=(part.x + dx, part.y + dy))
 
     def kill(self):
         for child in self.children:
@@ -711,6 +1653,8 @@ class Boss(AnimatedSprite):
 class BadGuy(AnimatedSprite):
     def __init__(self):
         super().__init__(boss_enemie, 3, 1, screen_size[0] // 2, screen_size[1] // 2, boss_group, 0)
+        # кадры кабины подменяются при снятии щита и разрушении, поэтому у каждого босса свой список
+        self.frames = list(self.frames)
         self.x = screen_size[0] // 2
         self.y = screen_size[1] // 2
         self.rot = 0
@@ -721,6 +1665,7 @@ class BadGuy(AnimatedSprite):
         self.rect = self.image.get_rect()
         self.color_key = self.image.get_at((0, 0))
         self.image.set_colorkey(self.color_key)
+        self.mask_im = boss_enemie_mask
         self.mask = pygame.mask.from_surface(boss_enemie_mask)
         self.rect.centerx = self.x
         self.rect.centery = self.y
@@ -753,60 +1698,99 @@ class Engine(AnimatedSprite):
 
 # инициализация переменных в игре
 # визуальная часть
-all_sprites = SpriteGroup()
-sprite_group = SpriteGroup()
-player_group = SpriteGroup()
-enemies_group = SpriteGroup()
-boss_group = SpriteGroup()
-overlap_group = SpriteGroup()
+spawn_order = count()
+all_sprites = SpriteGroup("all")
+sprite_group = SpriteGroup("sprites")
+player_group = SpriteGroup("player")
+enemies_group = SpriteGroup("enemies", ordered=True)
+boss_group = SpriteGroup("boss")
+overlap_group = SpriteGroup("overlap")
 running = True
 state = "start_screen"
 next_state = "game"
 time = 0
-black = pygame.transform.scale(load_image('fade_transition.png'), screen_size)
-white = pygame.transform.scale(load_image('fade_transition2.png'), screen_size)
-bgrnd = BackGround(load_image('bgrnd_space.png'), 50)
+assets = Assets()
+scene_assets = {
+    "start_screen": [('ttl_logo.png',), ('ttl_start.png', -1), ("ttl_current_level.png", -1),
+                     ("ttl_numbers.png", -1)],
+    "game": [("player_ship_anim_sheet.png", -1), ("player_ship.png", -1), ("health_bar_anim_sheet.png",),
+             ("blackhole_clouds.png",), ("laser_shot.png", None, (46, 46))],
+    "game_over": [("player_ship_broken.png", -1), ('bgrnd_space.png', None, None, True)],
+    "win": [("win_image.png", -1, screen_size), ("game_won.png", -1, screen_size),
+            ('bgrnd_space.png', None, None, True)],
+}
+black = assets.image('fade_transition.png', scale=screen_size)
+white = assets.image('fade_transition2.png', scale=screen_size)
+bgrnd = BackGround(assets.image('bgrnd_space.png', opaque=True), 50)
 fade = FadeTransition(black, 256)
-star_image = load_image("star_normal.png")
-star_piece_image = load_image("star_piece.png")
-instr_image = load_image("ttl_controls.png", -1)
-laser_blaster_handle_image = load_image("laser_blaster_handle.png")
-laser_blaster_image = load_image("laser_blaster_idle.png")
-laser_blaster_anim_sheet = load_image("laser_blaster_anim_sheet.png")
-boss_body = load_image("boss_back_part.png")
-boss_enemie = load_image("boss_cockpit.png")
-boss_enemie_inv = load_image("boss_cockpit_inv.png")
-boss_enemie_dead = load_image("boss_cockpit_dead.png")
-boss_enemie_shield_down = load_image("boss_cockpit_no_shield.png")
-boss_enemie_mask = load_image("boss_cockpit_mask.png", -1)
-boss_engine1 = load_image("boss_engine1.png")
-boss_engine1_inv = load_image("boss_engine1_inv.png")
-boss_engine1_dead = load_image("boss_engine1_dead.png")
-boss_engine2 = load_image("boss_engine2.png")
-boss_engine2_inv = load_image("boss_engine2_inv.png")
-boss_engine2_dead = load_image("boss_engine2_dead.png")
-bgrnd_boss_frames = [load_image(f"boss_background_anim/bgrnd_space_boss{i}.png") for i in range(60)]
-clock = pygame.time.Clock()
+star_image = assets.image("star_normal.png")
+star_rotations = RotationCache(star_image)
+pulse_cache = PulseCache()
+blackhole_frames = BlackHoleFrames("blackhole_generator.png")
+star_piece_image = assets.image("star_piece.png")
+instr_image = assets.image("ttl_controls.png", -1)
+laser_blaster_handle_image = assets.image("laser_blaster_handle.png")
+laser_blaster_image = assets.image("laser_blaster_idle.png")
+laser_blaster_anim_sheet = assets.image("laser_blaster_anim_sheet.png")
+# повороты общие для всех лазеров: при наведении угол меняется каждый кадр,
+# а при отлёте весь набор кадров анимации рисуется под одним углом;
+# у изображения наведения мягкие края, поэтому оно поворачивается без colorkey
+laser_blaster_aims = RotationCache(laser_blaster_image, 1, limit=64, keyed=False)
+laser_blaster_rotations = RotationBank(assets.frames(laser_blaster_anim_sheet, 3, 3), limit=8)
+boss_body = assets.image("boss_back_part.png")
+boss_enemie = assets.image("boss_cockpit.png")
+boss_enemie_inv = assets.image("boss_cockpit_inv.png")
+boss_enemie_dead = assets.image("boss_cockpit_dead.png")
+boss_enemie_shield_down = assets.image("boss_cockpit_no_shield.png")
+boss_enemie_mask = assets.image("boss_cockpit_mask.png", -1)
+boss_engine1 = assets.image("boss_engine1.png")
+boss_engine1_inv = assets.image("boss_engine1_inv.png")
+boss_engine1_dead = assets.image("boss_engine1_dead.png")
+boss_engine2 = assets.image("boss_engine2.png")
+boss_engine2_inv = assets.image("boss_engine2_inv.png")
+boss_engine2_dead = assets.image("boss_engine2_dead.png")
+# кадры заднего плана босса загружаются только к его уровню: из упакованного файла
+# (собирается anim_pack.py), если он есть, иначе из отдельных png;
+# BOSS_BGRND_WINDOW > 0 включает потоковый режим с ограниченным числом кадров в памяти
+BOSS_BGRND_PACK = os.path.join('data', 'bgrnd_space_boss.anim')
+BOSS_BGRND_WINDOW = 0
+if os.path.exists(BOSS_BGRND_PACK):
+    bgrnd_boss_pack = PackedAnimation(BOSS_BGRND_PACK)
+    bgrnd_boss_frames = LazyFrames(range(len(bgrnd_boss_pack)), BOSS_BGRND_WINDOW, load=bgrnd_boss_pack.__getitem__)
+else:
+    bgrnd_boss_frames = LazyFrames([f"boss_background_anim/bgrnd_space_boss{i}.png" for i in range(60)],
+                                   BOSS_BGRND_WINDOW, opaque=True)
+loop = GameLoop(FPS, RENDER_FPS)
+# все случайные события уровня берутся из rng, зерно задаёт controls.begin
+rng = random.Random()
+controls = Controls()
 logo = None
 start = None
 player = None
 health_bar = None
 boss = None
 # звуки
-start_sound = pygame.mixer.Sound("data/snd_start.ogg")
-hit_sound = pygame.mixer.Sound("data/snd_hit.ogg")
-star_explode_sound = pygame.mixer.Sound("data/snd_star_explode.ogg")
-die_sound = pygame.mixer.Sound("data/snd_die.ogg")
-revive_sound = pygame.mixer.Sound("data/snd_revive.ogg")
-you_won_sound = pygame.mixer.Sound("data/snd_you_won.ogg")
-win_sound = pygame.mixer.Sound("data/snd_win.ogg")
-del_sound = pygame.mixer.Sound("data/snd_delete_data.ogg")
-laser_sound = pygame.mixer.Sound("data/snd_laser.ogg")
-boss_hit_sound = pygame.mixer.Sound("data/snd_boss_hit.ogg")
-boss_explode_sound = pygame.mixer.Sound("data/snd_boss_explode.ogg")
+start_sound = assets.sound("snd_start.ogg")
+hit_sound = assets.sound("snd_hit.ogg")
+star_explode_sound = assets.sound("snd_star_explode.ogg")
+die_sound = assets.sound("snd_die.ogg")
+revive_sound = assets.sound("snd_revive.ogg")
+you_won_sound = assets.sound("snd_you_won.ogg")
+win_sound = assets.sound("snd_win.ogg")
+del_sound = assets.sound("snd_delete_data.ogg")
+laser_sound = assets.sound("snd_laser.ogg")
+boss_hit_sound = assets.sound("snd_boss_hit.ogg")
+boss_explode_sound = assets.sound("snd_boss_explode.ogg")
 # контроль объектов в сцене
 scene_objects = []
+bullets = BulletPool(group=enemies_group)
+stars = EntityPool(Star, 64, "stars", enemies_group)
+laser_blaster_pool = EntityPool(LaserBlaster, 16)
+black_hole_pool = EntityPool(BlackHole, 8)
+collisions = Collisions()
 camera = Camera()
+profiler = Profiler(PROFILE or PROFILE_DUMP is not None)
+renderer = Renderer(screen, all_sprites, DIRTY_RECTS)
 tborder = Border(-1, -1, screen_size[0] + 1, -1)
 bborder = Border(-1, screen_size[1] + 1, screen_size[0] + 1, screen_size[1] + 1)
 lborder = Border(-1, -1, -1, screen_size[1] + 1)
@@ -821,6 +1805,43 @@ for i in data:
 player_data_read.close()
 
 
+# сценарий уровня: события читаются из csv один раз, приводятся к числам и сортируются
+# по времени (при равном времени сохраняется порядок файла); за кадр выдаются только
+# наступившие события, поэтому стоимость кадра не зависит от длины уровня
+class LevelScript:
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.events) - self.cursor
+
+    def due(self, t):
+        start = self.cursor
+        while self.cursor < len(self.events) and self.events[self.cursor][0] <= t:
+            self.cursor += 1
+        return self.events[start:self.cursor]
+
+
+# уровень берётся из скомпилированного файла (собирается level_pack.py), если он не старее csv
+def load_level(name):
+    compiled = os.path.splitext(name)[0] + ".lvl"
+    try:
+        if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(name):
+            return CompiledLevel(compiled)
+        return LevelScript(read_csv(name))
+    except (OSError, ValueError) as message:
+        print('Не удаётся загрузить:', name)
+        raise SystemExit(message)
+
+
+# фоновая музыка сцены; при MUSIC = False (например, в режиме без окна) не загружается
+def play_music(name):
+    if MUSIC:
+        pygame.mixer.music.load(os.path.join('data', name))
+        pygame.mixer.music.play(-1)
+
+
 def make_level(s, b, l):
     # s - крайнее правое возвожное значение для рандома, так же влияет на шанс появления звезды
     # b - крайнее правое невкл. значение для получения чёрной дыры и крайнее левое вкл. значение для получения лазера
@@ -828,17 +1849,17 @@ def make_level(s, b, l):
     generate_level = open(f'data/lvl_0{data_dict["lvl"]}.csv', mode="w")
     res_str = ["time\ttype\tx\ty\tspeed\trot_spd"]
     for i in range(35):
-        v = random.randint(0, s)
+        v = rng.randint(0, s)
         if v in range(b):
             res_str.append(
-                f"{i * 1500}\tb_hole\t{random.randint(200, 824)}\t{random.randint(200, 568)}"
-                f"\t{random.randint(30, 120)}")
+                f"{i * 1500}\tb_hole\t{rng.randint(200, 824)}\t{rng.randint(200, 568)}"
+                f"\t{rng.randint(30, 120)}")
         elif v in range(b, l):
-            res_str.append(f"{i * 1500}\tl_blast\t{random.choice((1174, -150))}\t{random.randint(100, 668)}")
+            res_str.append(f"{i * 1500}\tl_blast\t{rng.choice((1174, -150))}\t{rng.randint(100, 668)}")
         else:
             res_str.append(
-                f"{i * 1500}\tstar\t{random.randint(100, 924)}\t-100\t{int((random.randint(115, 220) / 10) ** 2)}"
-                f"\t{random.randint(1, 360)}")
+                f"{i * 1500}\tstar\t{rng.randint(100, 924)}\t-100\t{int((rng.randint(115, 220) / 10) ** 2)}"
+                f"\t{rng.randint(1, 360)}")
     res_str.append(f"{38 * 1500}\twin")
     generate_level.write("\n".join(res_str))
     generate_level.close()
@@ -847,16 +1868,17 @@ def make_level(s, b, l):
 # инициализация и воспроизведение работы экрана запуска игры
 def start_screen():
     global logo, start, scene_objects, running, state, next_state, time
-    logo = Logo(load_image('ttl_logo.png'))
-    start = PressZToStartText(load_image('ttl_start.png', -1))
+    assets.preload("start_screen")
+    logo = Logo(assets.image('ttl_logo.png'))
+    start = PressZToStartText(assets.image('ttl_start.png', -1))
     instr = Instructions()
     lvl = CurLevel()
     lvl_txt = CurLevelText()
     scene_objects = [logo, start, instr, lvl, lvl_txt]
 
-    pygame.mixer.music.load('data/mus_start_screen.wav')
-    pygame.mixer.music.play(-1)
+    play_music('mus_start_screen.wav')
 
+    loop.reset()
     while running and state == "start_screen":
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -872,6 +1894,8 @@ def start_screen():
                     fade.fade = -1
                     pygame.mixer.music.stop()
                     pygame.mixer.Sound.play(start_sound)
+                    if int(data_dict["lvl"]) == levels:
+                        bgrnd_boss_frames.prefetch()
                 if event.key == pygame.K_ESCAPE:
                     running = False
                 if event.key == pygame.K_DELETE and fade.fade == 0:
@@ -879,20 +1903,22 @@ def start_screen():
                     pygame.mixer.Sound.play(del_sound)
                     data_dict["lvl"] = "1"
                     lvl.reset()
-        time += 1000 / FPS
-        bgrnd.update()
-        sprite_group.update()
-        overlap_group.update()
-        if fade.loaded:
-            start.image.set_alpha(255)
-            instr.image.set_alpha(255)
-            lvl.image.set_alpha(255)
-            lvl_txt.image.set_alpha(255)
-            fade.loaded = False
-        sprite_group.draw(screen)
-        overlap_group.draw(screen)
-        clock.tick(FPS)
-        pygame.display.flip()
+        for _ in range(loop.steps()):
+            if state != "start_screen":
+                break
+            renderer.save((bgrnd, sprite_group, overlap_group))
+            time += 1000 / FPS
+            bgrnd.update()
+            sprite_group.update()
+            overlap_group.update()
+            if fade.loaded:
+                start.image.set_alpha(255)
+                instr.image.set_alpha(255)
+                lvl.image.set_alpha(255)
+                lvl_txt.image.set_alpha(255)
+                fade.loaded = False
+        renderer.draw((bgrnd, sprite_group, overlap_group), alpha=loop.alpha())
+        renderer.flip()
     fade.fade = 1
     bgrnd.vel = 50
     time = 0
@@ -902,128 +1928,112 @@ def start_screen():
     scene_objects.clear()
 
 
+# границы поля уровня: на уровне босса игрок заперт в нижней части экрана,
+# на остальных уровнях - по краям экрана
+def set_borders(boss_fight):
+    global tborder, rborder, lborder
+    tborder.kill()
+    rborder.kill()
+    lborder.kill()
+    if boss_fight:
+        tborder = Border(-1, 230, screen_size[0] + 1, 230)
+        lborder = Border(30, -1, 30, screen_size[1] + 1)
+        rborder = Border(screen_size[0] - 30, -1, screen_size[0] - 30, screen_size[1] + 1)
+    else:
+        tborder = Border(-1, -1, screen_size[0] + 1, -1)
+        lborder = Border(-1, -1, -1, screen_size[1] + 1)
+        rborder = Border(screen_size[0] + 1, -1, screen_size[0] + 1, screen_size[1] + 1)
+
+
 # инициализация и воспроизведение работы игры
 def game():
     global player, health_bar, scene_objects, boss, running, state, next_state, time, data_dict, levels, fade, bgrnd
-    player = Player(load_image("player_ship_anim_sheet.png", -1), 4, 1,
+    assets.preload("game")
+    player = Player(assets.image("player_ship_anim_sheet.png", -1), 4, 1,
                     screen_size[0] // 2, screen_size[1] // 2, player_group, 6, 400, 1200,
-                    pygame.mask.from_surface(load_image("player_ship.png", -1)))
-    health_bar = HealthBar(load_image("health_bar_anim_sheet.png"), 3, 2, 20, 20, player_group)
-    scene_objects = [health_bar]
+                    pygame.mask.from_surface(assets.image("player_ship.png", -1)))
+    health_bar = HealthBar(assets.image("health_bar_anim_sheet.png"), 3, 2, 20, 20, player_group)
+    scene_objects = [health_bar, bullets, stars, laser_blaster_pool, black_hole_pool]
     auto_gen_level = True
     next_action_time = 0
+    controls.begin(int(data_dict["lvl"]))
+    # поле и задний план задаются при входе на каждый уровень и не зависят от предыдущего
+    set_borders(int(data_dict["lvl"]) == levels)
     if int(data_dict["lvl"]) == levels:
         bgrnd.kill()
         bgrnd = BossBackGround(50, 30)
         boss = Boss()
-        pygame.mixer.music.load('data/mus_boss_fight.wav')
-        global tborder, bborder, rborder, lborder
-        tborder.kill()
-        rborder.kill()
-        lborder.kill()
-        tborder = Border(-1, 230, screen_size[0] + 1, 230)
-        lborder = Border(30, -1, 30, screen_size[1] + 1)
-        rborder = Border(screen_size[0] - 30, -1, screen_size[0] - 30, screen_size[1] + 1)
+        music = 'mus_boss_fight.wav'
     else:
+        if isinstance(bgrnd, BossBackGround):
+            bgrnd.kill()
+            bgrnd = BackGround(assets.image('bgrnd_space.png', opaque=True), 50)
         auto_gen_level = False
         if data_dict["lvl"] == "4":
             make_level(7, 1, 3)
-        try:
-            with open(f'data/lvl_0{data_dict["lvl"]}.csv', encoding="utf8") as csvfile:
-                reader = csv.DictReader(csvfile, delimiter='\t', quotechar='"')
-                actions = list(reader)
-        except pygame.error as message:
-            print('Не удаётся загрузить:', f'data/lvl_0{data_dict["lvl"]}.csv')
-            raise SystemExit(message)
+        level = load_level(f'data/lvl_0{data_dict["lvl"]}.csv')
         if int(data_dict["lvl"]) % 2 == 0:
-            pygame.mixer.music.load('data/mus_meh_music.wav')
+            music = 'mus_meh_music.wav'
         else:
-            pygame.mixer.music.load('data/mus_acid_cool.wav')
-    pygame.mixer.music.play(-1)
-    active = [False, False, False, False]
+            music = 'mus_acid_cool.wav'
+    play_music(music)
+    # звёзды и пули рисуются под номером enemies_group вперемешку с врагами в порядке появления
+    layers = (bgrnd, sprite_group, boss_group, player_group, enemies_group, stars, bullets, overlap_group)
+    loop.reset()
+    profiler.start()
     while running and state == "game":
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
             elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    player.movey += -1
-                    active[0] = True
-                if event.key == pygame.K_DOWN:
-                    player.movey += 1
-                    active[1] = True
-                if event.key == pygame.K_LEFT:
-                    player.movex += -1
-                    active[2] = True
-                if event.key == pygame.K_RIGHT:
-                    player.movex += 1
-                    active[3] = True
-                if event.key == pygame.K_x:
-                    player.slow = True
+                if event.key == pygame.K_F3:
+                    profiler.toggle()
                 if event.key == pygame.K_ESCAPE:
                     running = False
-            elif event.type == pygame.KEYUP:
-                if event.key == pygame.K_UP and active[0]:
-                    player.movey -= -1
-                if event.key == pygame.K_DOWN and active[1]:
-                    player.movey -= 1
-                if event.key == pygame.K_LEFT and active[2]:
-                    player.movex -= -1
-                if event.key == pygame.K_RIGHT and active[3]:
-                    player.movex -= 1
-                if event.key == pygame.K_x:
-                    player.slow = False
-        time += 1000 / FPS
-        if auto_gen_level:
-            if next_action_time <= time:
-                v = random.randint(0, 7)
-                if v == 0:
-                    BlackHole(random.randint(200, 824), random.randint(300, 568), random.randint(30, 120))
-                elif v in range(1, 3):
-                    LaserBlaster(random.choice((1174, -150)), random.randint(350, 668))
-                else:
-                    Star(random.randint(100, 924), -100, int((random.randint(115, 195) / 10) ** 2),
-                         random.randint(1, 360))
-                next_action_time += 1000
-        else:
-            performed = []
-            for action in actions:
-                if int(action["time"]) <= time:
-                    if action["type"] == "star":
-                        Star(int(action["x"]), int(action["y"]), int(action["speed"]), int(action["rot_spd"]))
-                    elif action["type"] == "b_hole":
-                        BlackHole(int(action["x"]), int(action["y"]), int(action["speed"]))
-                    elif action["type"] == "l_blast":
-                        LaserBlaster(int(action["x"]), int(action["y"]))
-                    elif action["type"] == "win":
+            controls.handle(event)
+        profiler.mark("events")
+        steps = loop.steps()
+        profiler.mark("wait")
+        for _ in range(steps):
+            if state != "game":
+                break
+            renderer.save(layers)
+            time += 1000 / FPS
+            player.control(controls.step())
+            if auto_gen_level:
+                if next_action_time <= time:
+                    v = rng.randint(0, 7)
+                    if v == 0:
+                        black_hole_pool.get(rng.randint(200, 824), rng.randint(300, 568), rng.randint(30, 120))
+                    elif v in range(1, 3):
+                        laser_blaster_pool.get(rng.choice((1174, -150)), rng.randint(350, 668))
+                    else:
+                        stars.get(rng.randint(100, 924), -100, int((rng.randint(115, 195) / 10) ** 2),
+                                      rng.randint(1, 360))
+                    next_action_time += 1000
+            else:
+                for t, kind, x, y, speed, rot_spd in level.due(time):
+                    if kind == "star":
+                        stars.get(x, y, speed, rot_spd)
+                    elif kind == "b_hole":
+                        black_hole_pool.get(x, y, speed)
+                    elif kind == "l_blast":
+                        laser_blaster_pool.get(x, y)
+                    elif kind == "win":
                         next_state = "win"
                         fade.fade = -1
                         fade.image = white
                         fade.image.set_alpha(0)
-                    performed.append(action)
-            for action in performed:
-                actions.remove(action)
-        bgrnd.update()
-        sprite_group.update()
-        boss_group.update()
-        player_group.update()
-        enemies_group.update()
-        overlap_group.update()
-        for obj in all_sprites:
-            if obj.rect is not None:
-                camera.apply(obj)
-        screen.fill(pygame.Color("black"))
-        sprite_group.draw(screen)
-        boss_group.draw(screen)
-        player_group.draw(screen)
-        enemies_group.draw(screen)
-        overlap_group.draw(screen)
-        clock.tick(FPS)
-        pygame.display.flip()
-        camera.update((-camera.x, -camera.y))
-        for obj in all_sprites:
-            if obj.rect is not None:
-                camera.apply(obj)
+            profiler.mark("level")
+            for layer in layers:
+                layer.update()
+                profiler.mark("update " + layer.name)
+            collisions.check()
+            profiler.mark("collisions")
+        renderer.draw(layers, camera.offset(), loop.alpha())
+        renderer.flip()
+        profiler.end_frame(layers)
+    controls.end(state != "game")
     pygame.mixer.music.stop()
     pygame.mixer.Sound.stop(hit_sound)
     pygame.mixer.Sound.stop(star_explode_sound)
@@ -1031,6 +2041,9 @@ def game():
     time = 0
     if state == "win":
         data_dict["lvl"] = str(int(data_dict["lvl"]) + 1)
+        # кадры заднего плана босса подгружаются в фоне, пока идёт экран победы
+        if int(data_dict["lvl"]) == levels:
+            bgrnd_boss_frames.prefetch()
     for obj in scene_objects:
         obj.kill()
     scene_objects.clear()
@@ -1038,8 +2051,9 @@ def game():
 
 def game_over():
     global player, bgrnd, scene_objects, running, state, next_state, time, fade
+    assets.preload("game_over")
     broken_ship = pygame.sprite.Sprite(sprite_group)
-    broken_ship.image = load_image("player_ship_broken.png", -1)
+    broken_ship.image = assets.image("player_ship_broken.png", -1)
     broken_ship.rect = broken_ship.image.get_rect().move((player.rect.x, player.rect.y))
     bgrnd.kill()
     fade.spd = 200
@@ -1047,7 +2061,8 @@ def game_over():
     fade.image.set_alpha(0)
     scene_objects = []
 
-    pygame.mixer.Sound(die_sound).play()
+    pygame.mixer.Sound.play(die_sound)
+    loop.reset()
     while running and state == "game_over":
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -1059,19 +2074,20 @@ def game_over():
                     pygame.mixer.Sound.play(revive_sound)
                 if event.key == pygame.K_ESCAPE:
                     running = False
-        screen.fill(pygame.Color("Black"))
-        time += 1000 / FPS
-        sprite_group.update()
-        overlap_group.update()
-        sprite_group.draw(screen)
-        overlap_group.draw(screen)
-        clock.tick(FPS)
-        pygame.display.flip()
+        for _ in range(loop.steps()):
+            if state != "game_over":
+                break
+            renderer.save((sprite_group, overlap_group))
+            time += 1000 / FPS
+            sprite_group.update()
+            overlap_group.update()
+        renderer.draw((sprite_group, overlap_group), alpha=loop.alpha())
+        renderer.flip()
     time = 0
     fade.fade = 1
     broken_ship.kill()
     player.kill()
-    bgrnd = BackGround(load_image('bgrnd_space.png'), 50)
+    bgrnd = BackGround(assets.image('bgrnd_space.png', opaque=True), 50)
     fade.spd = 256
     for obj in scene_objects:
         obj.kill()
@@ -1080,13 +2096,14 @@ def game_over():
 
 def game_won():
     global player, bgrnd, scene_objects, running, state, next_state, time, fade, data_dict, levels
+    assets.preload("win")
     victory_screen = pygame.sprite.Sprite(sprite_group)
     if int(data_dict["lvl"]) <= levels:
-        victory_screen.image = pygame.transform.scale(load_image("win_image.png", -1), screen_size)
+        victory_screen.image = assets.image("win_image.png", -1, screen_size)
         next_state = "game"
         pygame.mixer.Sound.play(win_sound)
     else:
-        victory_screen.image = pygame.transform.scale(load_image("game_won.png", -1), screen_size)
+        victory_screen.image = assets.image("game_won.png", -1, screen_size)
         next_state = "quit"
         data_dict["lvl"] = str(int(data_dict["lvl"]) - 1)
         pygame.mixer.Sound.play(you_won_sound)
@@ -1101,6 +2118,7 @@ def game_won():
     fade.fade = 1
     player.kill()
 
+    loop.reset()
     while running and state == "win":
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -1112,19 +2130,20 @@ def game_won():
                         pygame.mixer.Sound.play(start_sound)
                 if event.key == pygame.K_ESCAPE:
                     running = False
-        screen.fill(pygame.Color("Black"))
-        time += 1000 / FPS
-        sprite_group.update()
-        overlap_group.update()
-        sprite_group.draw(screen)
-        overlap_group.draw(screen)
-        clock.tick(FPS)
-        pygame.display.flip()
+        for _ in range(loop.steps()):
+            if state != "win":
+                break
+            renderer.save((sprite_group, overlap_group))
+            time += 1000 / FPS
+            sprite_group.update()
+            overlap_group.update()
+        renderer.draw((sprite_group, overlap_group), alpha=loop.alpha())
+        renderer.flip()
     time = 0
     fade.fade = 1
     for obj in scene_objects:
         obj.kill()
-    bgrnd = BackGround(load_image('bgrnd_space.png'), 50)
+    bgrnd = BackGround(assets.image('bgrnd_space.png', opaque=True), 50)
     fade.spd = 256
     for obj in scene_objects:
         obj.kill()
@@ -1141,6 +2160,8 @@ if __name__ == "__main__":
         else:
             game_won()
     pygame.quit()
+    if PROFILE_DUMP is not None:
+        profiler.dump(PROFILE_DUMP)
     # сохранение всех изменённых данных
     player_data_write = open("data/player_data.ini", mode="w")
     res_str = []
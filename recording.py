@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# запись управления: зерно генератора случайных чисел уровня и маска нажатых клавиш
+# на каждом шаге симуляции. Клавиши меняются редко, поэтому маски сжимаются zlib
+# до нескольких байт на секунду игры. finished - уровень закончился сам (победа
+# или поражение), а не был прерван выходом из игры или ограничением числа кадров.
+#
+# воспроизведение записи:
+#     python headless.py --replay <файл.rec> ...
+import zlib
+import struct
+
+MAGIC = b"STRC"
+VERSION = 2
+# магия, версия, зерно, уровень, число шагов, уровень закончился сам
+HEADER = struct.Struct("<4sHIHI?")
+
+
+class Recording:
+    def __init__(self, seed, lvl, keys=b"", finished=False):
+        self.seed = seed
+        self.lvl = lvl
+        self.keys = bytearray(keys)
+        self.finished = finished
+
+    def __len__(self):
+        return len(self.keys)
+
+    def save(self, name):
+        with open(name, mode="wb") as packed:
+            packed.write(HEADER.pack(MAGIC, VERSION, self.seed, self.lvl, len(self.keys), self.finished))
+            packed.write(zlib.compress(bytes(self.keys), 9))
+
+
+def load(name):
+    with open(name, mode="rb") as packed:
+        buf = packed.read()
+    magic, version, seed, lvl, count, finished = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{name}: неизвестный формат записи")
+    keys = zlib.decompress(buf[HEADER.size:])
+    if len(keys) != count:
+        raise ValueError(f"{name}: запись повреждена")
+    return Recording(seed, lvl, keys, finished)